@@ -1,9 +1,15 @@
-import sqlite3, json, threading, time, multiprocessing, os, io, csv, contextlib
+import sqlite3, json, threading, time, multiprocessing, os, io, csv, contextlib, hashlib, socket, socketserver, uuid, sys, itertools, asyncio, math, cProfile, collections
+import re, glob, zlib, heapq, queue, functools, subprocess, hmac
+import concurrent.futures
 
-import run
-from run import Case, Interface, Profile, make_from_json
+import run, codec, tracing
+from run import Interface, AsyncInterface, PersistentInterface, CrossCheckInterface, Profile, Staging, Sweep, make_from_json, \
+    LAUNCH_PROFILES, launch_args, cds_archive, STORES, OVERALL, project_output
+from cache import FileDigests, ResultCache
+from tracing import span
 
-TMP='/tmp/batch'
+# Stands in for the sample name in case templates and their profile blobs
+SAMPLE = '{sample}'
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -25,171 +31,2141 @@ class JSONDecoder(json.JSONDecoder):
             return make_from_json(cls, d)
         return d
 
+class ReadOnlyFormat(Exception):
+    pass
+
+def canonical_profile(data):
+    # Sample names don't affect the LRs, so siblings with the same genotypes
+    # should fingerprint the same.
+    rows = csv.reader(io.StringIO(data))
+    hdr = next(rows)
+    skip = hdr.index('SampleName') if 'SampleName' in hdr else None
+    return json.dumps([hdr] + [
+        [v for i, v in enumerate(row) if i != skip] for row in rows
+    ])
+
 class Row:
     def __init__(self, case, rowid, files):
         self.case, self.rowid, self.files = case, rowid, files
+        self.inputs = None  # fingerprint() of what the output was computed from
+        self.started = self.finished = None  # when LRmix ran for it (epoch seconds)
 
-    def run_on_in(self, wd, intf):
-        cleanup = []
-        initcwd = os.getcwd()
-        try:
-            for fn, data in self.files.items():
-                path = os.path.join(wd, fn)
-                with open(path, 'w') as f:
-                    f.write(data)
-                cleanup.append(path)
-            os.chdir(wd) # make these references relative
-            return intf.run(self.case)
-        finally:
-            try:
-                os.chdir(initcwd)
-            except OSError:
-                pass
+    def fingerprint(self, digests, staged=None):
+        '''Hash of everything that determines this row's output: the case
+        arguments with every file replaced by a digest of its contents, and
+        sample names replaced by their position. Staged profiles are
+        replaced by `staged(path)` instead, if given.'''
+        files = self.files or {}
+        aliases = {name: f'#{i}' for i, name in enumerate(self.case.profiles)}
+        def resolve(path):
+            if path in files:
+                if staged is not None:
+                    return staged(path)
+                return hashlib.sha256(canonical_profile(files[path]).encode()).hexdigest()
+            return digests(path)
+        args = list(self.case.args(resolve, aliases.__getitem__))
+        return hashlib.sha256(json.dumps(args).encode()).hexdigest()
 
-            for path in cleanup:
-                try:
-                    os.unlink(path)
-                except OSError:
-                    pass
+    def run(self, intf, staging):
+        with staging.files(self.files or {}) as resolve:
+            return intf.run(self.case, resolve)
+
+    async def run_async(self, intf, staging):
+        with staging.files(self.files or {}) as resolve:
+            return await intf.run_async(self.case, resolve)
+
+def case_shape(case):
+    '''What the run time of a case mostly depends on.'''
+    return f'{case.hyp.p.unknown_num},{case.hyp.d.unknown_num},{len(case.replicates)},{len(case.profiles)}'
+
+def case_group(case):
+    '''Cases sharing population and evidence files.'''
+    key = json.dumps([sorted({h.population for h in case.hyp}), sorted(case.replicates)])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def prior_cost(shape):
+    # Seconds, before we've measured anything: JVM startup plus a sum over
+    # roughly 55 genotypes per unknown, once per replicate.
+    up, ud, reps, _ = map(int, shape.split(','))
+    return 0.5 + 1e-4 * (55 ** up + 55 ** ud) * max(reps, 1)
+
+def population_name(path):
+    # e.g. .../Asian_FST_Frequencies.csv -> Asian
+    return os.path.basename(path).partition('_')[0]
+
+def pivot_overall(rows):
+    '''Turn iter_overall() rows into ((label, sample), {population name: LR}),
+    one contributor at a time. Relies on the rows being grouped by
+    contributor, so it only ever holds one of them.'''
+    for key, grp in itertools.groupby(rows, key=lambda r: (r[0], r[1])):
+        yield key, {population_name(pop): lr for _, _, pop, lr, _ in grp}
+
+def progress(it, total, what, interval=5.0, out=sys.stderr):
+    last = time.monotonic()
+    n = 0
+    for n, item in enumerate(it, 1):
+        yield item
+        now = time.monotonic()
+        if now - last >= interval:
+            print(f'{what} {n}/{total} ({100.0*n/max(total, 1):.2f}%)', file=out)
+            last = now
+    print(f'{what} {n}/{total}, done', file=out)
+
+def to_float(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+def result_rows(rowid, output):
+    '''Rows for the results table from an output's rows.'''
+    for rec in output:
+        yield rowid, rec['Locus'], to_float(rec.get('LR')), to_float(rec.get('LRLog10'))
+
+def claim_key():
+    # Unique across threads, processes, hosts and restarts
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}'
 
 class Database:
-    def __init__(self, db):
+    # Columns added since the original schema: (name, declaration)
+    MIGRATIONS = [
+        ('lease', 'REAL NOT NULL DEFAULT 0'),  # claim expiry; 0 when unclaimed
+        ('shape', 'TEXT DEFAULT NULL'),  # case_shape()
+        ('grp', 'TEXT DEFAULT NULL'),  # case_group()
+        ('cost', 'REAL NOT NULL DEFAULT 0'),  # estimated seconds
+        ('population', 'TEXT DEFAULT NULL'),  # Hp population path
+        ('sample', 'TEXT DEFAULT NULL'),  # first profile's sample name
+        ('label', 'TEXT DEFAULT NULL'),  # props['case']
+        ('template', 'INTEGER DEFAULT NULL'),  # blob of the case, instead of case_data
+        ('file_refs', 'TEXT DEFAULT NULL'),  # {name: blob}, instead of files
+        ('inputs', 'TEXT DEFAULT NULL'),  # Row.fingerprint() the output was computed from
+        # When (epoch seconds) the row was last claimed, LRmix started and
+        # exited for it (NULL on cache hits), and its output was committed
+        ('claimed', 'REAL DEFAULT NULL'),
+        ('started', 'REAL DEFAULT NULL'),
+        ('finished', 'REAL DEFAULT NULL'),
+        ('committed', 'REAL DEFAULT NULL'),
+        ('worker', 'TEXT DEFAULT NULL'),  # claim key of whoever last claimed it
+        ('failed', 'REAL DEFAULT NULL'),  # when a run gave up on it; not claimed again until retry_failed()
+    ]
+    # Kept up to date by triggers, so progress needn't count the whole table
+    COUNTERS = {
+        'total': 'SELECT count(*) FROM cases',
+        'finished': 'SELECT count(*) FROM cases WHERE output IS NOT NULL',
+        'claimed': 'SELECT count(*) FROM cases WHERE claimant IS NOT NULL',
+    }
+    # What claim_cases and friends need to rebuild a Row, see _rows()
+    ROW = 'rowid, case_data, files, template, sample, file_refs'
+    # Bumped when backfill() has something new to fill in for old rows
+    BACKFILL = 1
+    # Fetched and decoded at a time when rewriting case_data
+    CONVERT_CHUNK = 5000
+
+    def __init__(self, db, readonly=False):
+        '''With `readonly`, opening writes nothing (not even the schema)
+        when the database is already up to date, and the connection can't
+        write, so status and extract never hold up a run's commits.'''
+        self.path = db
         self.lock = threading.Lock()
-        self.db = sqlite3.connect(db, check_same_thread = False)
+        self.db = sqlite3.connect(db, timeout = 60, check_same_thread = False)
         self.db.isolation_level = 'EXCLUSIVE'
+        # Per connection; NORMAL sync is still crash-safe in WAL mode
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if readonly and self.up_to_date():
+            self.db.execute('PRAGMA query_only=ON')
+        else:
+            self.create_schema()
+        self.jd = JSONDecoder()  # for databases from before the codec
+        self.templates = {}  # blob id -> derived columns, see add_template
+        # Cases are stored as JSON ('json') or codec-encoded (its version).
+        # JSON databases can be read and run, but need convert_cases() before
+        # new cases can be added.
+        self.case_format = self.get_meta('case_format', 'json')
+        # What set_outputs keeps of outputs (run.STORES), and the dictionaries
+        # they're compressed with
+        self.store = self.get_meta('store', 'full')
+        self.zdicts = dict(self.db.execute('SELECT id, data FROM zdicts'))
+
+    def up_to_date(self):
+        '''Whether create_schema() would find nothing to do.'''
+        try:
+            cols = {row[1] for row in self.db.execute('PRAGMA table_info(cases)')}
+            return (self.db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+                    and all(name in cols for name, _ in self.MIGRATIONS)
+                    and self.db.execute('SELECT count(*) FROM counters').fetchone()[0] >= len(self.COUNTERS)
+                    and self.get_meta('backfill', 0) >= self.BACKFILL
+                    and self.db.execute("SELECT 1 FROM sqlite_master WHERE name='cost_model'").fetchone() is not None)
+        except sqlite3.OperationalError:  # a table is missing
+            return False
+
+    def create_schema(self):
+        self.enable_wal()
         self.db.executescript('''
             CREATE TABLE IF NOT EXISTS cases (
                 case_data TEXT,
                 files TEXT DEFAULT NULL,
                 claimant INTEGER DEFAULT NULL,
-                output TEXT DEFAULT NULL
+                output TEXT DEFAULT NULL  -- codec.encode_output() (JSON text before)
             );
-
+        ''')
+        self.migrate()
+        self.db.executescript('''
             CREATE INDEX IF NOT EXISTS cases_claimed ON cases (claimant)
                 WHERE claimant IS NOT NULL;
 
-            CREATE INDEX IF NOT EXISTS cases_done ON cases (output)
-                WHERE output IS NOT NULL;
+            -- Was a copy of every output, and nothing needed it
+            DROP INDEX IF EXISTS cases_done;
+
+            CREATE INDEX IF NOT EXISTS cases_pending ON cases (lease)
+                WHERE output IS NULL;
+
+            CREATE INDEX IF NOT EXISTS cases_cost ON cases (cost)
+                WHERE output IS NULL;
+
+            CREATE INDEX IF NOT EXISTS cases_sched ON cases (grp, cost)
+                WHERE output IS NULL;
+
+            CREATE INDEX IF NOT EXISTS cases_shape ON cases (shape)
+                WHERE output IS NULL;
+
+            CREATE INDEX IF NOT EXISTS cases_label ON cases (label, sample, population);
+
+            CREATE INDEX IF NOT EXISTS cases_point ON cases (template, sample)
+                WHERE template IS NOT NULL;
+
+            CREATE INDEX IF NOT EXISTS cases_committed ON cases (committed)
+                WHERE committed IS NOT NULL;
+
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            );
+
+            CREATE TRIGGER IF NOT EXISTS counters_insert AFTER INSERT ON cases BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'total';
+                UPDATE counters SET value = value + 1 WHERE name = 'finished' AND NEW.output IS NOT NULL;
+                UPDATE counters SET value = value + 1 WHERE name = 'claimed' AND NEW.claimant IS NOT NULL;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS counters_delete AFTER DELETE ON cases BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'total';
+                UPDATE counters SET value = value - 1 WHERE name = 'finished' AND OLD.output IS NOT NULL;
+                UPDATE counters SET value = value - 1 WHERE name = 'claimed' AND OLD.claimant IS NOT NULL;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS counters_output AFTER UPDATE OF output ON cases
+                WHEN (OLD.output IS NULL) != (NEW.output IS NULL) BEGIN
+                UPDATE counters SET value = value + iif(NEW.output IS NULL, -1, 1) WHERE name = 'finished';
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS counters_claimant AFTER UPDATE OF claimant ON cases
+                WHEN (OLD.claimant IS NULL) != (NEW.claimant IS NULL) BEGIN
+                UPDATE counters SET value = value + iif(NEW.claimant IS NULL, -1, 1) WHERE name = 'claimed';
+            END;
+
+            CREATE TABLE IF NOT EXISTS results (
+                case_id INTEGER,  -- cases.rowid
+                locus TEXT,
+                lr REAL,
+                lr_log10 REAL,
+                PRIMARY KEY (locus, case_id)
+            ) WITHOUT ROWID;
+
+            CREATE INDEX IF NOT EXISTS results_case ON results (case_id);
+
+            CREATE TABLE IF NOT EXISTS blobs (
+                id INTEGER PRIMARY KEY,
+                digest BLOB UNIQUE,
+                data
+            );
+
+            CREATE TABLE IF NOT EXISTS input_files (
+                path TEXT PRIMARY KEY,  -- every file outputs were computed from
+                mtime INTEGER,  -- ns
+                size INTEGER,
+                digest TEXT  -- FileDigests
+            );
+
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            );
+
+            CREATE TABLE IF NOT EXISTS zdicts (
+                id INTEGER PRIMARY KEY,
+                data BLOB  -- codec.train_zdict()
+            );
+
+            CREATE TABLE IF NOT EXISTS cost_model (
+                shape TEXT PRIMARY KEY,
+                n INTEGER,
+                mean REAL,  -- measured seconds per case
+                applied REAL  -- the estimate pending rows were last given
+            );
         ''')
-        self.je = JSONEncoder()
-        self.jd = JSONDecoder()
+        if self.db.execute('SELECT count(*) FROM counters').fetchone()[0] < len(self.COUNTERS):
+            for name, query in self.COUNTERS.items():
+                # Counted once, for databases from before the triggers
+                self.db.execute(f'INSERT OR IGNORE INTO counters SELECT ?, ({query})', (name,))
+            self.db.commit()
+        if self.db.execute('SELECT 1 FROM cases LIMIT 1').fetchone() is None:
+            # Nothing old to backfill or convert in a fresh database
+            self.set_meta('backfill', self.BACKFILL)
+            self.set_meta('case_format', codec.VERSION)
+            self.db.commit()
+
+    def migrate(self):
+        cols = {row[1] for row in self.db.execute('PRAGMA table_info(cases)')}
+        for name, decl in self.MIGRATIONS:
+            if name not in cols:
+                self.db.execute(f'ALTER TABLE cases ADD COLUMN {name} {decl}')
+        self.db.commit()
+
+    def enable_wal(self):
+        # Lets readers (Observer, status, extract) proceed while workers
+        # write, and makes each commit an append instead of a rollback-journal
+        # dance. Stays set in the file once it is.
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def set_store(self, store):
+        assert store in STORES
+        self.set_meta('store', store)
+        self.db.commit()
+        self.store = store
+
+    def zdict(self, outputs):
+        '''The newest dictionary to compress outputs with, made from
+        `outputs` (lists of rows) if there's none yet.'''
+        if not self.zdicts:
+            data = codec.train_zdict(outputs)
+            if not data:
+                return 0, None
+            cur = self.db.execute('INSERT INTO zdicts (data) VALUES (?)', (data,))
+            self.zdicts[cur.lastrowid] = data
+        zid = max(self.zdicts)
+        return zid, self.zdicts[zid]
+
+    def decode_output(self, data):
+        '''An output's rows, however it was stored.'''
+        if not isinstance(data, str) and codec.output_zdict_id(data) not in self.zdicts:
+            # Made by another process since we looked
+            self.zdicts = dict(self.db.execute('SELECT id, data FROM zdicts'))
+        return codec.decode_output(data, self.zdicts)
+
+    def estimates(self):
+        '''shape -> estimated seconds, for the shapes we've measured.'''
+        return dict(self.db.execute('SELECT shape, mean FROM cost_model WHERE n >= 3'))
+
+    def encode_case(self, case):
+        if self.case_format != codec.VERSION:
+            raise ReadOnlyFormat(f'{self.path} stores cases as {self.case_format}; '
+                                 f'run `batch.py {self.path} migrate` before adding to it')
+        return codec.encode(case)
+
+    def decode_case(self, data):
+        return self.jd.decode(data) if isinstance(data, str) else codec.decode(data)
+
+    def convert_cases(self):
+        '''Re-encode every case (and template) stored as JSON with the codec;
+        returns how many were converted.'''
+        count = 0
+        with self.lock:
+            last = 0
+            while True:
+                rows = self.db.execute(
+                    'SELECT rowid, case_data FROM cases WHERE rowid > ? AND typeof(case_data) = \'text\' '
+                    'ORDER BY rowid LIMIT ?', (last, self.CONVERT_CHUNK)
+                ).fetchall()
+                if not rows:
+                    break
+                self.db.executemany('UPDATE cases SET case_data=? WHERE rowid=?', [
+                    (codec.encode(self.jd.decode(jo)), rowid) for rowid, jo in rows
+                ])
+                self.db.commit()
+                last = rows[-1][0]
+                count += len(rows)
+            tids = [tid for tid, in self.db.execute('SELECT DISTINCT template FROM cases WHERE template IS NOT NULL')]
+            for tid, data in self.get_blobs(tids).items():
+                if isinstance(data, str):
+                    data = codec.encode(self.jd.decode(data))
+                    self.db.execute('UPDATE blobs SET digest=?, data=? WHERE id=?',
+                                    (hashlib.sha256(data).digest(), data, tid))
+                    count += 1
+            self.set_meta('case_format', codec.VERSION)
+            self.db.commit()
+        self.case_format = codec.VERSION
+        return count
+
+    def convert_outputs(self):
+        '''Compress every output stored as JSON (keeping all of it, whatever
+        the store); returns how many were converted.'''
+        count = 0
+        with self.lock:
+            last = 0
+            while True:
+                rows = self.db.execute(
+                    'SELECT rowid, output FROM cases WHERE rowid > ? AND typeof(output) = \'text\' '
+                    'ORDER BY rowid LIMIT ?', (last, self.CONVERT_CHUNK)
+                ).fetchall()
+                if not rows:
+                    break
+                outputs = [json.loads(output) for _, output in rows]
+                zid, zdict = self.zdict(outputs)
+                self.db.executemany('UPDATE cases SET output=? WHERE rowid=?', [
+                    (codec.encode_output(output, zid, zdict), rowid) for (rowid, _), output in zip(rows, outputs)
+                ])
+                self.db.commit()
+                last = rows[-1][0]
+                count += len(rows)
+        return count
+
+    def merge(self, path):
+        '''Copy the cases of the database at `path` into this one, with their
+        outputs and results, skipping templated cases this one already has.
+        Claims aren't copied. Returns how many cases were copied.'''
+        src = Database(path)
+        try:
+            if src.case_format != codec.VERSION:
+                raise ReadOnlyFormat(f'{path} stores cases as {src.case_format}; '
+                                     f'run `batch.py {path} migrate` before merging it')
+            src.backfill()
+            store, zdicts = src.store, src.zdicts
+        finally:
+            src.db.close()
+        with self.lock:
+            fresh = self.total_cases() == 0
+            self.db.commit()
+            self.db.execute('ATTACH DATABASE ? AS src', (path,))
+            try:
+                # Blobs and dictionaries get new ids here; outputs say which
+                # dictionary they need, so they're relabelled on the way
+                self.db.execute('INSERT OR IGNORE INTO blobs(digest, data) SELECT digest, data FROM src.blobs')
+                self.db.execute('DROP TABLE IF EXISTS temp.blob_map')
+                self.db.execute('CREATE TEMP TABLE blob_map (old INTEGER PRIMARY KEY, new INTEGER)')
+                self.db.execute('INSERT INTO temp.blob_map SELECT s.id, b.id FROM src.blobs s JOIN main.blobs b USING (digest)')
+                ids = {data: zid for zid, data in self.zdicts.items()}
+                zmap = {}
+                for zid, data in sorted(zdicts.items()):
+                    if data not in ids:
+                        ids[data] = self.db.execute('INSERT INTO zdicts (data) VALUES (?)', (data,)).lastrowid
+                    zmap[zid] = ids[data]
+                self.zdicts = {zid: data for data, zid in ids.items()}
+                self.db.create_function('relabel_output', 1,
+                                        lambda data: codec.relabel_output(data, zmap) if isinstance(data, bytes) else data)
+                # Rows keep their order, after ours
+                offset, = self.db.execute('SELECT coalesce(max(rowid), 0) FROM main.cases').fetchone()
+                cols = [row[1] for row in self.db.execute('PRAGMA main.table_info(cases)')
+                        if row[1] not in ('template', 'file_refs', 'output', 'claimant', 'lease')]
+                cur = self.db.execute(f'''
+                    INSERT INTO main.cases(rowid, template, file_refs, output, claimant, lease, {", ".join(cols)})
+                    SELECT c.rowid + :offset, m.new, iif(c.file_refs IS NULL, NULL, (
+                        SELECT json_group_object(j.key, f.new) FROM json_each(c.file_refs) j
+                        JOIN temp.blob_map f ON f.old = j.value
+                    )), relabel_output(c.output), NULL, 0, {", ".join("c." + col for col in cols)}
+                    FROM src.cases c LEFT JOIN temp.blob_map m ON m.old = c.template
+                    WHERE m.new IS NULL OR NOT EXISTS (
+                        SELECT 1 FROM main.cases WHERE template = m.new AND sample IS c.sample
+                    )
+                    ORDER BY c.rowid
+                ''', {'offset': offset})
+                count = cur.rowcount
+                self.db.execute('''
+                    INSERT OR REPLACE INTO main.results
+                    SELECT r.case_id + :offset, r.locus, r.lr, r.lr_log10 FROM src.results r
+                    JOIN main.cases c ON c.rowid = r.case_id + :offset
+                ''', {'offset': offset})
+                self.db.execute('INSERT OR IGNORE INTO main.input_files SELECT * FROM src.input_files')
+                self.db.execute('INSERT OR IGNORE INTO main.cost_model SELECT * FROM src.cost_model')
+                if fresh:
+                    self.set_meta('store', store)
+                    self.store = store
+                self.db.execute('DROP TABLE temp.blob_map')
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+            finally:
+                self.db.execute('DETACH DATABASE src')
+        return count
+
+    @staticmethod
+    def case_columns(case, est):
+        '''Values of the derived columns for a case.'''
+        shape = case_shape(case)
+        return {
+            'shape': shape,
+            'grp': case_group(case),
+            'cost': est.get(shape) or prior_cost(shape),
+            'population': case.hyp.p.population,
+            'sample': next(iter(case.profiles), None),
+            'label': case.props.get('case'),
+        }
 
     def add_cases(self, *cases):
         rows = []
+        est = self.estimates()
         for case in cases:
-            cur = self.db.execute('INSERT INTO cases(case_data) VALUES (?)',
-                                  (self.je.encode(case),))
+            cols = self.case_columns(case, est)
+            cur = self.db.execute(
+                f'INSERT INTO cases(case_data, {", ".join(cols)}) VALUES (?{", ?" * len(cols)})',
+                (self.encode_case(case), *cols.values())
+            )
             rows.append(Row(case, cur.lastrowid, None))
         return rows
 
+    def backfill(self):
+        '''Fill in derived columns and results for rows stored before they
+        existed. Only does anything once per BACKFILL version.'''
+        if self.get_meta('backfill', 0) >= self.BACKFILL:
+            return 0
+        est = self.estimates()
+        count = 0
+        with self.lock:
+            last = 0
+            while True:
+                records = self.db.execute(
+                    f'SELECT {self.ROW}, output FROM cases WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last, self.CONVERT_CHUNK)
+                ).fetchall()
+                if not records:
+                    break
+                for row, output in zip(self._rows([rec[:-1] for rec in records]), (rec[-1] for rec in records)):
+                    cols = self.case_columns(row.case, est)
+                    self.db.execute(f'UPDATE cases SET {", ".join(c + "=?" for c in cols)} WHERE rowid=?',
+                                    (*cols.values(), row.rowid))
+                    if output is not None:
+                        self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                                            result_rows(row.rowid, self.decode_output(output)))
+                self.db.commit()
+                last = records[-1][0]
+                count += len(records)
+            # Only once every chunk is in, so an interrupted backfill resumes
+            self.set_meta('backfill', self.BACKFILL)
+            self.db.commit()
+        return count
+
+    def blob_ids(self, datas):
+        '''Store each of `datas` once, keyed by content; returns their ids.'''
+        digests = [hashlib.sha256(d.encode() if isinstance(d, str) else d).digest() for d in datas]
+        self.db.executemany('INSERT OR IGNORE INTO blobs(digest, data) VALUES (?, ?)', zip(digests, datas))
+        ids = {}
+        for i in range(0, len(digests), 500):
+            chunk = digests[i:i + 500]
+            ids.update(self.db.execute(
+                f'SELECT digest, id FROM blobs WHERE digest IN ({", ".join("?" * len(chunk))})', chunk
+            ))
+        return [ids[d] for d in digests]
+
+    def get_blobs(self, ids):
+        ids = list(ids)
+        res = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            res.update(self.db.execute(
+                f'SELECT id, data FROM blobs WHERE id IN ({", ".join("?" * len(chunk))})', chunk
+            ))
+        return res
+
+    def add_template(self, case):
+        '''Store a case whose profile is named SAMPLE, to be instantiated by
+        add_templated(); returns its id.'''
+        tid, = self.blob_ids([self.encode_case(case)])
+        self.templates[tid] = self.case_columns(case, self.estimates())
+        return tid
+
+    def add_templated(self, entries, chunk=10000):
+        '''Bulk-add cases from (template id, sample, {name: contents}) entries,
+        where the contents say SAMPLE wherever the sample name goes. Entries
+        whose template and sample are already in the database are skipped.
+        Commits every `chunk` entries; returns how many were added.'''
+        count = 0
+        entries = iter(entries)
+        while True:
+            batch = list(itertools.islice(entries, chunk))
+            if not batch:
+                return count
+            ids = iter(self.blob_ids([data for _, _, files in batch for data in files.values()]))
+            rows = []
+            for tid, sample, files in batch:
+                cols = dict(self.templates[tid], sample=sample)
+                refs = {name: next(ids) for name in files}
+                rows.append((tid, json.dumps(refs), *cols.values(), tid, sample))
+            cur = self.db.executemany(f'''
+                INSERT INTO cases(template, file_refs, {", ".join(cols)}) SELECT ?, ?{", ?" * len(cols)}
+                WHERE NOT EXISTS (SELECT 1 FROM cases WHERE template=? AND sample=?)
+            ''', rows)
+            self.db.commit()
+            count += cur.rowcount
+
+    def _rows(self, records):
+        '''Rows from records of the ROW columns, whether stored whole or as
+        template + blobs.'''
+        with span('decode', rows=len(records)):
+            refs = [json.loads(rec[5]) if rec[5] else {} for rec in records]
+            blobs = self.get_blobs(
+                {rec[3] for rec in records if rec[3] is not None} | {i for ref in refs for i in ref.values()}
+            )
+            rows = []
+            for (rowid, jo, files, tid, sample, _), ref in zip(records, refs):
+                if tid is None:
+                    rows.append(Row(self.decode_case(jo), rowid, json.loads(files) if files else None))
+                else:
+                    case = self.decode_case(blobs[tid]).rename_profile(SAMPLE, sample)
+                    rows.append(Row(case, rowid, {name: blobs[i].replace(SAMPLE, sample) for name, i in ref.items()}))
+            return rows
+
+    def _iter_rows(self, where='1', chunk=1000):
+        '''(Row, output) for every row matching `where`, a chunk at a time.'''
+        cur = self.db.execute(f'SELECT {self.ROW}, output FROM cases WHERE {where}')
+        while True:
+            records = cur.fetchmany(chunk)
+            if not records:
+                break
+            yield from zip(self._rows([rec[:-1] for rec in records]), (rec[-1] for rec in records))
+
+    def schedule(self):
+        '''Bring every pending row's cost up to date with the model.'''
+        self.backfill()
+        for shape, cost in self.estimates().items():
+            self.db.execute('UPDATE cases SET cost=? WHERE shape=? AND output IS NULL', (cost, shape))
+            self.db.execute('UPDATE cost_model SET applied=? WHERE shape=?', (cost, shape))
+        self.db.commit()
+
     def set_files(self, row, files):
         self.db.execute('UPDATE cases SET files=? WHERE rowid=?',
                         (json.dumps(files), row.rowid))
 
-    def claim_cases(self, claim_key, size=64):
+    def claim_cases(self, claim_key, size=64, lease=300, budget=60):
+        '''Claim up to `size` unfinished rows for `lease` seconds. Rows whose
+        lease has run out (their claimant died or hung) are fair game.
+
+        The most expensive pending row picks the population/evidence group,
+        and rows are then taken from that group in decreasing cost order
+        until about `budget` estimated seconds are claimed, so expensive
+        cases go out first and one at a time, and cheap ones in bulk.'''
         assert claim_key is not None
-        with self.lock:
-            #cur = self.db.execute('BEGIN EXCLUSIVE')
-            cur = self.db.execute('SELECT rowid FROM cases WHERE claimant IS NULL and output IS NULL LIMIT ?', (size,))
-            rows = [i[0] for i in cur.fetchall()]
-            cur.executemany('UPDATE cases SET claimant=? WHERE rowid=?',
-                            ((claim_key, row) for row in rows))
+        now = time.time()
+        with self.lock, span('claim'):
+            # One statement, so the claim is atomic even across processes
+            cur = self.db.execute(f'''
+                UPDATE cases SET claimant=:key, lease=:until, worker=:key, claimed=:now WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, sum(cost) OVER (ORDER BY cost DESC, rowid DESC) - cost AS before FROM (
+                            SELECT rowid, cost FROM cases WHERE output IS NULL AND lease < :now AND failed IS NULL AND grp IS (
+                                SELECT grp FROM cases WHERE output IS NULL AND lease < :now AND failed IS NULL
+                                ORDER BY cost DESC LIMIT 1
+                            ) ORDER BY cost DESC, rowid DESC LIMIT :size
+                        )
+                    ) WHERE before < :budget
+                ) RETURNING {self.ROW}
+            ''', {'key': claim_key, 'until': now + lease, 'now': now, 'size': size, 'budget': budget})
+            claimed = cur.fetchall()
             self.db.commit()
-        cur = self.db.cursor()
-        res = [None] * size
-        for idx, row in enumerate(rows):
-            cur.execute('SELECT case_data, files FROM cases WHERE rowid=?', (row,))
-            jo, files = cur.fetchone()
-            case = self.jd.decode(jo)
-            res[idx] = Row(case, row, json.loads(files))
-        return res
+        return self._rows(claimed)
+
+    def set_outputs(self, items, timings=()):
+        '''Store many (row, output) pairs in one transaction, and fold
+        (shape, seconds) measurements into the cost model. Outputs are the
+        rows LRmix wrote, encoded here and only here.'''
+        with self.lock, span('commit', rows=len(items)):
+            now = time.time()
+            outputs = [project_output(output, self.store) for _, output in items]
+            zid, zdict = self.zdict(outputs)
+            self.db.executemany('''
+                UPDATE cases SET output=?, inputs=?, started=?, finished=?, committed=?, claimant=NULL, lease=0
+                WHERE rowid=?
+            ''', ((codec.encode_output(output, zid, zdict), row.inputs, row.started, row.finished, now, row.rowid)
+                  for (row, _), output in zip(items, outputs)))
+            self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                                (res for (row, _), output in zip(items, outputs) for res in result_rows(row.rowid, output)))
+            self.learn(timings)
+            self.db.commit()
+
+    def learn(self, timings):
+        shapes = set()
+        for shape, secs in timings:
+            self.db.execute('''
+                INSERT INTO cost_model VALUES (?, 1, ?, NULL) ON CONFLICT (shape)
+                DO UPDATE SET n=n+1, mean=mean+(excluded.mean-mean)/(n+1)
+            ''', (shape, secs))
+            shapes.add(shape)
+        for shape in shapes:
+            n, mean, applied = self.db.execute('SELECT n, mean, applied FROM cost_model WHERE shape=?', (shape,)).fetchone()
+            # Re-cost pending rows only when the estimate moved noticeably
+            if n >= 3 and (applied is None or abs(mean - applied) > 0.2 * applied):
+                self.db.execute('UPDATE cases SET cost=? WHERE shape=? AND output IS NULL', (mean, shape))
+                self.db.execute('UPDATE cost_model SET applied=? WHERE shape=?', (mean, shape))
 
     def set_output(self, row, output):
         assert output is not None
+        self.set_outputs([(row, output)])
+
+    def renew(self, claim_key, lease=300):
         with self.lock:
-            self.db.execute('UPDATE cases SET output=?, claimant=NULL WHERE rowid=?', (output, row.rowid))
+            self.db.execute('UPDATE cases SET lease=? WHERE claimant=? AND output IS NULL',
+                            (time.time() + lease, claim_key))
             self.db.commit()
 
+    def release(self, rowids):
+        '''Give up our claim on unfinished rows, so others may take them.'''
+        with self.lock:
+            self.db.executemany('UPDATE cases SET claimant=NULL, lease=0 WHERE rowid=? AND output IS NULL',
+                                ((rowid,) for rowid in rowids))
+            self.db.commit()
+
+    def fail(self, rowids):
+        '''Give up on unfinished rows until retry_failed(), so the rest of
+        this run doesn't keep trying (and waiting for) them.'''
+        now = time.time()
+        with self.lock:
+            self.db.executemany('UPDATE cases SET claimant=NULL, lease=0, failed=? WHERE rowid=? AND output IS NULL',
+                                ((now, rowid) for rowid in rowids))
+            self.db.commit()
+
+    def failed_cases(self):
+        return self.db.execute('SELECT count(*) FROM cases WHERE failed IS NOT NULL AND output IS NULL').fetchone()[0]
+
+    def retry_failed(self):
+        '''Let the rows earlier runs gave up on be claimed again.'''
+        with self.lock:
+            cur = self.db.execute('UPDATE cases SET failed=NULL WHERE failed IS NOT NULL')
+            self.db.commit()
+        return cur.rowcount
+
+    def counter(self, name):
+        return self.db.execute('SELECT value FROM counters WHERE name=?', (name,)).fetchone()[0]
+
     def total_cases(self):
-        return self.db.execute('SELECT count(*) FROM cases').fetchone()[0]
+        return self.counter('total')
 
     def progressing_cases(self):
-        return self.db.execute('SELECT count(*) FROM cases WHERE claimant IS NOT NULL').fetchone()[0]
+        return self.counter('claimed')
 
     def finished_cases(self):
-        return self.db.execute('SELECT count(*) FROM cases WHERE output IS NOT NULL').fetchone()[0]
+        return self.counter('finished')
+
+    def latencies(self, by='shape'):
+        '''(`by` column, seconds LRmix took) of every finished row that ran,
+        fastest first.'''
+        return self.db.execute(f'''
+            SELECT {by}, finished - started AS secs FROM cases
+            WHERE output IS NOT NULL AND started IS NOT NULL ORDER BY secs
+        ''').fetchall()
 
-    def clean(self):
-        cur = self.db.execute('UPDATE cases SET claimant=NULL WHERE output IS NULL')
+    def worker_rates(self):
+        '''(worker, cases, first claim, last commit) for each claim key.'''
+        return self.db.execute('''
+            SELECT worker, count(*), min(claimed), max(committed) FROM cases
+            WHERE output IS NOT NULL AND committed IS NOT NULL GROUP BY worker ORDER BY 2 DESC
+        ''').fetchall()
+
+    def throughput(self, bucket=60, since=0):
+        '''(bucket start, cases committed in it), for buckets of `bucket`
+        seconds after `since`.'''
+        return self.db.execute('''
+            SELECT CAST(committed / :b AS INTEGER) * :b AS t, count(*) FROM cases
+            WHERE committed > :since AND output IS NOT NULL GROUP BY t ORDER BY t
+        ''', {'b': bucket, 'since': since}).fetchall()
+
+    def slowest(self, n=10):
+        return self.db.execute('''
+            SELECT rowid, label, sample, population, shape, finished - started AS secs FROM cases
+            WHERE output IS NOT NULL AND started IS NOT NULL ORDER BY secs DESC LIMIT ?
+        ''', (n,)).fetchall()
+
+    def next_claim(self, claim_key=None):
+        '''Seconds until there could be a row for `claim_key` to claim (0 if
+        there may be one now): the soonest lease held by anyone else runs
+        out. None once every row is finished (or failed).'''
+        query = 'SELECT min(lease) FROM cases WHERE output IS NULL AND failed IS NULL'
+        if claim_key is None:
+            until, = self.db.execute(query).fetchone()
+        else:
+            until, = self.db.execute(query + ' AND claimant IS NOT ?', (claim_key,)).fetchone()
+        if until is None:
+            return None
+        return max(0.0, until - time.time())
+
+    def stale_cases(self):
+        return self.db.execute('SELECT count(*) FROM cases WHERE output IS NULL AND claimant IS NOT NULL AND lease < ?',
+                               (time.time(),)).fetchone()[0]
+
+    def clean(self, everything=False):
+        '''Release expired claims, or all of them (even live ones) if
+        `everything`.'''
+        cur = self.db.execute('UPDATE cases SET claimant=NULL, lease=0 WHERE output IS NULL AND claimant IS NOT NULL AND lease < ?',
+                              (float('inf') if everything else time.time(),))
         self.db.commit()
         return cur.rowcount
 
+    def save_digests(self, digests):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO input_files VALUES (?, ?, ?, ?)', digests.entries())
+            self.db.commit()
+
+    def load_digests(self, digests):
+        digests.load(self.db.execute('SELECT path, mtime, size, digest FROM input_files'))
+        return digests
+
+    def refresh(self, digests=None, dry_run=False):
+        '''Invalidate finished rows whose inputs (files or parameters) changed
+        since their output was computed, so the next run redoes just those.
+        Returns (checked, invalidated, missing files).
+
+        Files are only re-hashed if their mtime or size changed, and only
+        rows whose population and evidence group uses a changed file (or
+        whose profiles live on disk) are fingerprinted again. Results from
+        before inputs were recorded are taken to be current.'''
+        digests = self.load_digests(digests or FileDigests())
+        changed, missing = set(), []
+        for path, _, _, digest in self.db.execute('SELECT * FROM input_files').fetchall():
+            try:
+                if digests(path) != digest:
+                    changed.add(path)
+            except OSError:
+                missing.append(path)
+        grps = []
+        for grp, jo, tid in self.db.execute(
+                'SELECT grp, case_data, template FROM cases WHERE rowid IN (SELECT min(rowid) FROM cases GROUP BY grp)'
+        ).fetchall():
+            case = self.decode_case(jo if tid is None else self.get_blobs([tid])[tid])
+            if changed & ({h.population for h in case.hyp} | case.replicates):
+                grps.append(grp)
+        cur = self.db.execute(f'''
+            SELECT {self.ROW}, inputs FROM cases WHERE output IS NOT NULL AND (
+                inputs IS NULL OR (files IS NULL AND file_refs IS NULL)
+                OR grp IN (SELECT value FROM json_each(?))
+            )
+        ''', (json.dumps(grps),))
+        checked, stale, adopt = 0, [], []
+        while True:
+            records = cur.fetchmany(1000)
+            if not records:
+                break
+            for row, (*_, inputs) in zip(self._rows([rec[:-1] for rec in records]), records):
+                checked += 1
+                try:
+                    fp = row.fingerprint(digests)
+                except OSError:
+                    continue  # Left alone until the file is back
+                if inputs is None:
+                    adopt.append((fp, row.rowid))
+                elif fp != inputs:
+                    stale.append((row.rowid,))
+        if not dry_run:
+            with self.lock:
+                self.db.executemany('UPDATE cases SET inputs=? WHERE rowid=?', adopt)
+                self.db.executemany('UPDATE cases SET output=NULL, inputs=NULL WHERE rowid=?', stale)
+                self.db.executemany('DELETE FROM results WHERE case_id=?', stale)
+                self.db.executemany('INSERT OR REPLACE INTO input_files VALUES (?, ?, ?, ?)', digests.entries())
+                self.db.commit()
+        return checked, len(stale), missing
+
     def reset(self):
         cur = self.db.execute('UPDATE cases SET output=NULL')
+        self.db.execute('DELETE FROM results')
         self.db.commit()
         return cur.rowcount
 
     def iter_results(self):
-        cur = self.db.execute('SELECT case_data, output FROM cases WHERE output IS NOT NULL')
-        for row in cur:
-            case, data = self.jd.decode(row[0]), json.loads(row[1])
-            yield case, data
+        for row, output in self._iter_rows('output IS NOT NULL'):
+            yield row.case, self.decode_output(output)
+
+    def populations(self):
+        '''Population names (as extract uses them) of every case, sorted.'''
+        paths = self.db.execute('SELECT DISTINCT population FROM cases WHERE population IS NOT NULL')
+        return sorted({population_name(path) for path, in paths})
+
+    def iter_overall(self):
+        '''(label, sample, population path, LR, LRLog10) of every finished
+        case, ordered by label and sample, straight from the results table.'''
+        # CROSS JOIN keeps cases (via cases_label) as the outer loop, so this
+        # streams in index order without any temporary sort.
+        return self.db.execute('''
+            SELECT c.label, c.sample, c.population, max(r.lr), max(r.lr_log10)
+            FROM cases c CROSS JOIN results r ON r.case_id = c.rowid AND r.locus = '_OVERALL_'
+            GROUP BY c.label, c.sample, c.population
+            ORDER BY c.label, c.sample, c.population
+        ''')
+
+class ResultWriter:
+    '''Group-commits outputs: they are buffered and written in one transaction
+    once `max_rows` are pending or the oldest has waited `max_delay` seconds.
+
+    Rows stay claimed until their output is committed, so a crash only loses
+    buffered results, which are then simply run again. Nothing else checks
+    the time, so whoever owns the writer should call flush_due() regularly
+    (see Heartbeat).'''
+    def __init__(self, db, max_rows=64, max_delay=5.0):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timings = []
+        self.since = None
+
+    def add(self, row, output, elapsed=None):
+        assert output is not None
+        with self.lock:
+            if not self.pending:
+                self.since = time.monotonic()
+            self.pending.append((row, output))
+            if elapsed is not None:
+                self.timings.append((case_shape(row.case), elapsed))
+            if len(self.pending) >= self.max_rows or time.monotonic() - self.since >= self.max_delay:
+                self._flush()
+
+    def flush_due(self):
+        with self.lock:
+            if self.pending and time.monotonic() - self.since >= self.max_delay:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.db.set_outputs(self.pending, self.timings)
+            self.pending = []
+            self.timings = []
+
+class Heartbeat(threading.Thread):
+    '''Keeps renewing the leases held by one claimant until told to stop,
+    and commits what `writer` has had waiting too long in between.'''
+    def __init__(self, db, key, lease, writer=None):
+        super().__init__(daemon = True)
+        self.db = db
+        self.key = key
+        self.lease = lease
+        self.writer = writer
+        self.die = threading.Event()
+
+    def run(self):
+        interval = self.lease / 3
+        tick = min(interval, self.writer.max_delay / 2) if self.writer is not None else interval
+        renewed = time.monotonic()
+        while not self.die.wait(tick):
+            if self.writer is not None:
+                self.writer.flush_due()
+            if time.monotonic() - renewed >= interval:
+                self.db.renew(self.key, self.lease)
+                renewed = time.monotonic()
+
+@contextlib.contextmanager
+def profiled(path):
+    '''cProfile the calling thread into `path`, unless that's None.'''
+    if path is None:
+        yield
+        return
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # Python 3.12+ only allows one active profiler per process
+        print(f'Not profiling into {path}: another profiler is active', file=sys.stderr)
+        yield
+        return
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(path)
+
+def profile_path(directory, key):
+    return None if directory is None else os.path.join(directory, key.replace(':', '_') + '.prof')
+
+def read_meminfo():
+    '''/proc/meminfo, in bytes.'''
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            name, val = line.split(':', 1)
+            info[name] = int(val.split()[0]) << 10
+    return info
+
+def cpu_times():
+    '''(idle, total) jiffies of all CPUs so far, and runnable processes.'''
+    idle = total = running = 0
+    with open('/proc/stat') as f:
+        for line in f:
+            if line.startswith('cpu '):
+                vals = list(map(int, line.split()[1:]))
+                idle, total = vals[3] + vals[4], sum(vals[:8])
+            elif line.startswith('procs_running '):
+                running = int(line.split()[1])
+    return idle, total, running
+
+def swapped_out():
+    with open('/proc/vmstat') as f:
+        for line in f:
+            if line.startswith('pswpout '):
+                return int(line.split()[1])
+    return 0
+
+def child_processes(pid):
+    '''{pid: (RSS in bytes, unknowns from its arguments or None)} of the
+    children of `pid`.'''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The name may hold anything, so fields count from its end
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            if ppid != pid:
+                continue
+            with open(f'/proc/{entry}/status') as f:
+                rss = next((int(line.split()[1]) << 10 for line in f if line.startswith('VmRSS:')), 0)
+            with open(f'/proc/{entry}/cmdline') as f:
+                argv = f.read().split('\0')
+        except (OSError, IndexError, ValueError):
+            continue  # gone already, or not ours to read
+        unknowns = [int(argv[i + 1]) for i, arg in enumerate(argv[:-1]) if arg in ('-Hpu', '-Hdu') and argv[i + 1].isdigit()]
+        children[int(entry)] = (rss, max(unknowns) if unknowns else None)
+    return children
+
+def case_unknowns(case):
+    return max(case.hyp.p.unknown_num, case.hyp.d.unknown_num)
+
+class Governor(threading.Thread):
+    '''Adapts how many of `max_jobs` executors are active, between
+    `min_jobs` and `max_jobs`, from what /proc says every `interval`
+    seconds, and holds back cases whose expected memory won't fit.
+
+    Each LRmix process' peak RSS is learned per number of unknowns (from
+    its arguments); until one has been seen, a case is expected to need
+    `case_memory` bytes. A case is admitted if that fits in MemAvailable
+    less `reserve`, less what admitted cases have yet to grow into; and
+    always if nothing else is running. The number of active executors
+    shrinks while memory is short or swapping, or the CPUs are
+    oversubscribed, and grows while they're idle and every active executor
+    is busy. Decisions are logged on stderr.'''
+    def __init__(self, max_jobs, min_jobs=1, reserve=1 << 30, case_memory=1 << 30, interval=2.0, out=sys.stderr):
+        super().__init__(daemon=True)
+        self.max_jobs = max_jobs
+        self.min_jobs = max(1, min(min_jobs, max_jobs))
+        self.reserve = reserve
+        self.case_memory = case_memory
+        self.interval = interval
+        self.out = out
+        self.cond = threading.Condition()
+        self.target = max(self.min_jobs, min(max_jobs, os.cpu_count() or 1))
+        self.running = 0  # cases admitted
+        self.reserved = 0  # bytes expected of them
+        self.draining = False  # set once some executor found nothing to claim
+        self.memory = {}  # unknowns -> peak RSS seen
+        self.peaks = {}  # pid -> (peak RSS, unknowns)
+        self.free = None  # MemAvailable - reserve at the last sample
+        self.rss = 0  # RSS of our LRmix processes at the last sample
+        self.held = False  # whether a case is being held back, to log it once
+        self.die = threading.Event()
+
+    def log(self, msg):
+        print(f'Adaptive: {msg}', file=self.out)
+
+    def expected(self, unknowns):
+        return self.memory.get(unknowns, self.case_memory)
+
+    def wait_active(self, index):
+        '''Block executor `index` while it's not among the active ones.'''
+        with self.cond:
+            self.cond.wait_for(lambda: index < self.target or self.draining)
+
+    def is_active(self, index):
+        return index < self.target or self.draining
+
+    def drain(self):
+        with self.cond:
+            self.draining = True
+            self.cond.notify_all()
+
+    def fits(self, need):
+        if self.running == 0 or self.free is None:
+            return True
+        # What admitted cases still have to grow into, roughly
+        return need + max(0, self.reserved - self.rss) <= self.free
+
+    @contextlib.contextmanager
+    def admit(self, rows):
+        '''Wait until the memory `rows` (run in one LRmix process) are
+        expected to need is available, and account for it meanwhile.'''
+        unknowns = max(case_unknowns(row.case) for row in rows)
+        need = self.expected(unknowns)
+        with self.cond:
+            if not self.fits(need):
+                if not self.held:
+                    self.log(f'holding a case with {unknowns} unknowns: expects {need / 2**30:.2f} GiB, '
+                             f'{(self.free - max(0, self.reserved - self.rss)) / 2**30:.2f} GiB to spare')
+                    self.held = True
+                self.cond.wait_for(lambda: self.fits(need))
+                self.held = False
+            self.running += 1
+            self.reserved += need
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.reserved -= need
+                self.cond.notify_all()
+
+    def learn(self):
+        children = child_processes(os.getpid())
+        for pid, (rss, unknowns) in children.items():
+            peak = self.peaks.get(pid, (0, unknowns))[0]
+            self.peaks[pid] = (max(peak, rss), unknowns)
+        for pid in [pid for pid in self.peaks if pid not in children]:
+            peak, unknowns = self.peaks.pop(pid)
+            if unknowns is not None and peak > self.memory.get(unknowns, 0):
+                if peak > 1.1 * self.memory.get(unknowns, 0):
+                    self.log(f'cases with {unknowns} unknowns take up to {peak / 2**20:.0f} MiB')
+                self.memory[unknowns] = peak
+        return sum(rss for rss, _ in children.values())
+
+    def resize(self, target, why):
+        target = max(self.min_jobs, min(self.max_jobs, target))
+        if target != self.target:
+            self.log(f'{self.target} -> {target} jobs ({why})')
+            self.target = target
+            self.cond.notify_all()
+
+    def run(self):
+        idle, total, _ = cpu_times()
+        swapped = swapped_out()
+        cpus = os.cpu_count() or 1
+        while not self.die.wait(self.interval):
+            rss = self.learn()
+            avail = read_meminfo().get('MemAvailable', 0)
+            now_idle, now_total, runnable = cpu_times()
+            busy = 1 - (now_idle - idle) / max(1, now_total - total)
+            idle, total = now_idle, now_total
+            now_swapped = swapped_out()
+            swapping, swapped = now_swapped > swapped, now_swapped
+            state = f'CPU {100 * busy:.0f}% busy, {runnable} runnable, {avail / 2**30:.2f} GiB available'
+            with self.cond:
+                self.free, self.rss = avail - self.reserve, rss
+                self.cond.notify_all()
+                if swapping or avail < self.reserve:
+                    self.resize(self.target - 1, f'short of memory{", swapping" if swapping else ""}; {state}')
+                elif busy > 0.95 and runnable > 2 * cpus:
+                    self.resize(self.target - 1, f'CPUs oversubscribed; {state}')
+                elif busy < 0.85 and self.running >= self.target and \
+                        avail - self.reserve > max(self.memory.values(), default=self.case_memory):
+                    self.resize(self.target + 1, f'CPUs underused; {state}')
+
+def profile_loci(data):
+    '''A profile's header line, and its lines and alleles by locus.'''
+    lines = data.splitlines(keepends=True)
+    hdr = next(csv.reader(lines[:1]))
+    loci = {}
+    for line, rec in zip(lines[1:], csv.reader(lines[1:])):
+        rec = dict(zip(hdr, rec))
+        ent = loci.setdefault(rec['Marker'], ([], set()))
+        ent[0].append(line)
+        ent[1].update(v for k, v in rec.items() if k.startswith('Allele') and v)
+    return lines[0], loci
+
+def combine_loci(rows, with_h):
+    '''LRmix's output from its per-locus rows: _OVERALL_ is their product
+    (and the sum of their logs).'''
+    prod = lambda field: repr(math.prod(float(row[field]) for row in rows))
+    overall = {'Locus': OVERALL}
+    if 'Hp' in rows[0]:
+        overall.update({'Hp': prod('Hp') if with_h else '', 'Hd': prod('Hd') if with_h else ''})
+    overall.update({'LR': prod('LR'), 'LRLog10': repr(sum(float(row['LRLog10']) for row in rows))})
+    return rows + [overall]
+
+class LocusMemo:
+    '''Per-locus output rows, keyed by the locus, the staged profiles'
+    genotypes there and everything else about the case, for siblings to
+    share (see LocusPlan). Shared by the executors of a process, and
+    forgotten least recently used first beyond `max_entries`.'''
+    def __init__(self, max_entries=1 << 18):
+        self.lock = threading.Lock()
+        self.memo = collections.OrderedDict()
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self.lock:
+            val = self.memo.get(key)
+            if val is not None:
+                self.memo.move_to_end(key)
+            return val
+
+    def put(self, key, val):
+        with self.lock:
+            self.memo[key] = val
+            self.memo.move_to_end(key)
+            while len(self.memo) > self.max_entries:
+                self.memo.popitem(last=False)
+
+def memo_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+class LocusPlan:
+    '''How to answer a row with staged profiles from a LocusMemo.
+
+    LRmix's per-locus LRs only depend on that locus, so they're looked up
+    one by one. Which loci an output has (its layout) is remembered per case
+    and set of profile loci, from the first full run. Loci not in the memo
+    are run with the staged profiles cut down to them, and the output is put
+    back together, _OVERALL_ included.'''
+    def __init__(self, memo, row, digests):
+        self.memo, self.row = memo, row
+        self.profiles = {path: profile_loci(data) for path, data in sorted(row.files.items())}
+        self.base = row.fingerprint(digests, staged=lambda path: '')
+        self.layout_key = memo_key(self.base, [list(loci) for _, loci in self.profiles.values()])
+        self.layout = memo.get(self.layout_key)  # (loci, whether _OVERALL_ has Hp and Hd)
+        self.found, self.missing = {}, []
+        if self.layout is not None:
+            for locus in self.layout[0]:
+                out = memo.get(self.locus_key(locus))
+                if out is None:
+                    self.missing.append(locus)
+                else:
+                    self.found[locus] = out
+
+    def locus_key(self, locus):
+        gts = [sorted(loci[locus][1]) if locus in loci else None for _, loci in self.profiles.values()]
+        return memo_key(self.base, locus, gts)
+
+    def restricted(self):
+        '''The row to run, its profiles cut down to the missing loci if
+        that's possible, or None if nothing needs to run.'''
+        if self.layout is None:
+            return self.row
+        if not self.missing:
+            return None
+        wanted = set(self.missing)
+        files = {}
+        for path, (hdr, loci) in self.profiles.items():
+            keep = [line for locus, (lines, _) in loci.items() if locus in wanted for line in lines]
+            if not keep:
+                return self.row
+            files[path] = ''.join([hdr] + keep)
+        return Row(self.row.case, self.row.rowid, files)
+
+    def complete(self, output, full):
+        '''The row's output, given that of restricted() (all loci if
+        `full`), remembering what can be; None if that didn't have every
+        locus we needed.'''
+        by_locus = {rec['Locus']: rec for rec in output if rec['Locus'] != OVERALL}
+        if full:
+            overall = [rec for rec in output if rec['Locus'] == OVERALL]
+            if by_locus and overall:
+                self.memo.put(self.layout_key, (list(by_locus), overall[0].get('Hp', '') != ''))
+                for locus, rec in by_locus.items():
+                    self.memo.put(self.locus_key(locus), rec)
+            return output
+        for locus in self.missing:
+            if locus not in by_locus:
+                return None
+            self.found[locus] = by_locus[locus]
+            self.memo.put(self.locus_key(locus), by_locus[locus])
+        loci, with_h = self.layout
+        return combine_loci([self.found[locus] for locus in loci], with_h)
+
+def cache_key(inputs, store):
+    '''The ResultCache key of an output cut down to `store`.'''
+    return inputs if store == 'full' else f'{inputs}:{store}'
 
 class Executor(threading.Thread):
-    def __init__(self, db, intf, size=64):
+    # Most seconds to wait before looking for work again, when all that's
+    # left is claimed by others (who may finish it, or die)
+    IDLE_POLL = 5.0
+
+    def __init__(self, db, intf, size=64, cache=None, digests=None, key=None, commit_rows=64, commit_delay=5.0, lease=300, budget=60, group=1, profile=None,
+                 loci=None, governor=None, index=0, store='full'):
         self.db = db
         self.intf = intf
         self.size = size
+        self.budget = budget
+        self.key = key
+        self.lease = lease
+        self.commit_rows = commit_rows
+        self.commit_delay = commit_delay
+        self.cache = cache
+        self.group = group
+        self.profile = profile  # directory to write a cProfile of this executor into
+        self.loci = loci  # LocusMemo, if answering from per-locus results
+        self.governor = governor  # Governor deciding whether we're active (as executor `index`)
+        self.index = index
+        self.store = store  # what intf keeps of outputs, so what the cache holds
+        self.digests = digests if digests is not None else FileDigests()
+        self.failed = []  # rowids of batches that raised
+        self.error = None  # what killed us, if anything did
         super().__init__()
 
+    def batches(self, rows):
+        '''Split claimed rows into runs of up to `group` cases sharing their
+        population and evidence, for one LRmix invocation each.'''
+        groups = {}
+        for row in rows:
+            groups.setdefault(case_group(row.case), []).append(row)
+        for grp in groups.values():
+            for i in range(0, len(grp), self.group):
+                yield grp[i:i + self.group]
+
+    def execute(self, rows, staging):
+        with contextlib.ExitStack() as stack:
+            with span('stage', rows=len(rows)):
+                items = [(row.case, stack.enter_context(staging.files(row.files or {}))) for row in rows]
+            start = time.time()
+            outs = self.intf.run_many(items)
+            end = time.time()
+        for row in rows:
+            row.started, row.finished = start, end
+        # Each gets its share, which is what the cost model should learn
+        each = (end - start) / len(rows)
+        return [(out, each) for out in outs]
+
+    def execute_loci(self, rows, staging):
+        '''Like execute, but going through self.loci for rows with staged
+        profiles (see LocusPlan).'''
+        with span('loci', rows=len(rows)):
+            plans = [LocusPlan(self.loci, row, self.digests) if row.files else None for row in rows]
+        runs = [row if plan is None else plan.restricted() for row, plan in zip(rows, plans)]
+        todo = [i for i, run in enumerate(runs) if run is not None]
+        res = [(None, None)] * len(rows)
+        if todo:
+            for i, out in zip(todo, self.execute([runs[i] for i in todo], staging)):
+                res[i] = out
+        for i, (row, plan, run) in enumerate(zip(rows, plans, runs)):
+            if plan is None:
+                continue
+            out, elapsed = res[i]
+            if run is None:
+                output = plan.complete([], False)
+            else:
+                row.started, row.finished = run.started, run.finished
+                output = plan.complete(out, run is row)
+            if output is None:
+                # LRmix left out loci we needed when run on the cut-down profiles
+                out, elapsed = self.execute([row], staging)[0]
+                output = plan.complete(out, True)
+            res[i] = output, elapsed
+        return res
+
+    def compute(self, rows, staging):
+        '''The rows' outputs, and how long LRmix took for each (None if it
+        didn't run).'''
+        keys = []
+        with span('fingerprint', rows=len(rows)):
+            for row in rows:
+                row.inputs = row.fingerprint(self.digests)
+                keys.append(cache_key(row.inputs, self.store))
+        execute = self.execute if self.loci is None else self.execute_loci
+        if self.cache is None:
+            return execute(rows, staging)
+        with span('cache', rows=len(rows)):
+            res = [(self.cache.get(key), None) for key in keys]
+        todo = [i for i, (out, _) in enumerate(res) if out is None]
+        if todo:
+            for i, (out, elapsed) in zip(todo, execute([rows[i] for i in todo], staging)):
+                self.cache.put(keys[i], out)
+                res[i] = out, elapsed
+        return res
+
     def run(self):
-        key = self.ident
-        wd = os.path.join(TMP, str(key))
-        os.makedirs(wd, exist_ok=True)
+        key = self.key or claim_key()
+        staging = Staging()
+        writer = ResultWriter(self.db, self.commit_rows, self.commit_delay)
+        heartbeat = Heartbeat(self.db, key, self.lease, writer)
+        heartbeat.start()
+        try:
+            with profiled(profile_path(self.profile, key)):
+                while True:
+                    if self.governor is not None and not self.governor.is_active(self.index):
+                        writer.flush()
+                        self.governor.wait_active(self.index)
+                    rows = self.db.claim_cases(key, self.size, self.lease, self.budget)
+                    if not rows:
+                        writer.flush()
+                        wait = self.db.next_claim(key)
+                        if wait is None:
+                            break
+                        time.sleep(min(max(wait, 0.1), self.IDLE_POLL))
+                        continue
+                    for batch in self.batches(rows):
+                        try:
+                            with self.governor.admit(batch) if self.governor is not None else contextlib.nullcontext():
+                                outs = self.compute(batch, staging)
+                        except Exception as e:
+                            print(f'Cases {", ".join(str(row.rowid) for row in batch)} failed: {type(e).__name__}: {e}',
+                                  file=sys.stderr)
+                            self.db.fail([row.rowid for row in batch])
+                            self.failed.extend(row.rowid for row in batch)
+                            continue
+                        for row, res in zip(batch, outs):
+                            writer.add(row, *res)
+        except BaseException as e:
+            self.error = e
+            raise
+        finally:
+            if self.governor is not None:
+                self.governor.drain()
+            heartbeat.die.set()
+            writer.flush()
+            self.db.save_digests(self.digests)
+            self.intf.close()
+            staging.close()
+
+class AsyncExecutor:
+    '''Runs up to `jobs` LRmix processes at once from a single asyncio event
+    loop, instead of a thread per job.
 
+    A producer claims rows into a queue of at most `prefetch`, blocking
+    while it's full (or waiting for others' claims to finish or run out
+    while there's nothing to claim), and `jobs` consumers run them. Database (and cache)
+    work is handed to one helper thread, so the loop never waits on SQLite.
+    Cases the interface times out are released when the run ends, for a
+    later run to retry.'''
+    def __init__(self, db, intf, jobs, size=64, cache=None, digests=None, key=None, prefetch=None,
+                 commit_rows=64, commit_delay=5.0, lease=300, budget=60, profile=None, store='full'):
+        self.db = db
+        self.intf = intf
+        self.jobs = jobs
+        self.size = size
+        self.budget = budget
+        self.key = key or claim_key()
+        self.prefetch = prefetch or 2 * jobs
+        self.lease = lease
+        self.commit_rows = commit_rows
+        self.commit_delay = commit_delay
+        self.cache = cache
+        self.digests = digests if digests is not None else FileDigests()
+        self.profile = profile
+        self.store = store
+        self.pool = concurrent.futures.ThreadPoolExecutor(1)
+        self.timed_out = []
+        self.failed = []
+
+    def call(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def compute(self, row, staging):
+        '''The row's output, and how long LRmix took (None if it didn't run).'''
+        row.inputs = row.fingerprint(self.digests)
+        key = cache_key(row.inputs, self.store)
+        if self.cache is not None:
+            out = await self.call(self.cache.get, key)
+            if out is not None:
+                return out, None
+        row.started = time.time()
+        out = await row.run_async(self.intf, staging)
+        row.finished = time.time()
+        elapsed = row.finished - row.started
+        if self.cache is not None:
+            await self.call(self.cache.put, key, out)
+        return out, elapsed
+
+    async def produce(self, queue):
         while True:
-            rows = self.db.claim_cases(key, self.size)
+            rows = await self.call(self.db.claim_cases, self.key, self.size, self.lease, self.budget)
             if not rows:
-                break
+                wait = await self.call(self.db.next_claim, self.key)
+                if wait is None:
+                    break
+                await asyncio.sleep(min(max(wait, 0.1), Executor.IDLE_POLL))
+                continue
             for row in rows:
-                out = row.run_on_in(wd, self.intf)
-                self.db.set_output(row, json.dumps(out))
+                await queue.put(row)
+        for _ in range(self.jobs):
+            await queue.put(None)
+
+    async def consume(self, queue, staging, writer):
+        while True:
+            row = await queue.get()
+            if row is None:
+                break
+            try:
+                res = await self.compute(row, staging)
+            except asyncio.TimeoutError:
+                print(f'Case {row.rowid} timed out after {self.intf.timeout}s', file=sys.stderr)
+                self.timed_out.append(row.rowid)
+                continue
+            except Exception as e:
+                print(f'Case {row.rowid} failed: {type(e).__name__}: {e}', file=sys.stderr)
+                await self.call(self.db.fail, [row.rowid])
+                self.failed.append(row.rowid)
+                continue
+            await self.call(writer.add, row, *res)
+
+    async def heartbeat(self, writer):
+        # Like Heartbeat
+        interval = self.lease / 3
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(min(interval, writer.max_delay / 2))
+            await self.call(writer.flush_due)
+            if time.monotonic() - renewed >= interval:
+                await self.call(self.db.renew, self.key, self.lease)
+                renewed = time.monotonic()
+
+    async def run(self):
+        staging = Staging()
+        writer = ResultWriter(self.db, self.commit_rows, self.commit_delay)
+        queue = asyncio.Queue(self.prefetch)
+        heartbeat = asyncio.ensure_future(self.heartbeat(writer))
+        tasks = [asyncio.ensure_future(self.produce(queue))]
+        tasks.extend(asyncio.ensure_future(self.consume(queue, staging, writer)) for _ in range(self.jobs))
+        try:
+            with profiled(profile_path(self.profile, self.key)):
+                await asyncio.gather(*tasks)
+        finally:
+            heartbeat.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(heartbeat, *tasks, return_exceptions=True)
+            await self.call(writer.flush)
+            await self.call(self.db.save_digests, self.digests)
+            await self.call(self.db.release, self.timed_out)
+            self.pool.shutdown()
+            staging.close()
+
+def percentile(vals, q):
+    '''The q-th percentile (0-100) of sorted `vals`, nearest rank.'''
+    if not vals:
+        return None
+    return vals[min(len(vals) - 1, max(0, math.ceil(q / 100 * len(vals)) - 1))]
+
+def format_duration(secs):
+    if secs is None or secs == math.inf:
+        return 'n/a'
+    secs = int(secs)
+    return f'{secs // 3600}:{secs // 60 % 60:02}:{secs % 60:02}'
 
 class Observer(threading.Thread):
-    def __init__(self, db, interval = 10):
+    '''Reports progress every `interval` seconds, from the counters, with
+    throughput (smoothed over ticks) and the ETA it implies. If `metrics` is
+    given, the same numbers are written there in the Prometheus text format,
+    for node_exporter's textfile collector or anything else to scrape.'''
+    def __init__(self, db, interval = 10, metrics = None):
         super().__init__(daemon = True)
         self.db = db
         self.interval = interval
+        self.metrics = metrics
         self.die = threading.Event()
+        self.last = None
+        self.rate = None
+
+    def tick(self):
+        total = self.db.total_cases()
+        progressing = self.db.progressing_cases()
+        finished = self.db.finished_cases()
+        now = time.monotonic()
+        if self.last is not None and now > self.last[0]:
+            rate = (finished - self.last[1]) / (now - self.last[0])
+            self.rate = rate if self.rate is None else 0.3 * rate + 0.7 * self.rate
+        self.last = (now, finished)
+        eta = (total - finished) / self.rate if self.rate else None
+        return total, progressing, finished, eta
+
+    def write_metrics(self, total, progressing, finished, eta):
+        tmp = f'{self.metrics}.tmp'
+        with open(tmp, 'w') as f:
+            for name, kind, help, val in (
+                    ('lrmix_cases', 'gauge', 'Cases in the database', total),
+                    ('lrmix_cases_running', 'gauge', 'Cases currently claimed', progressing),
+                    ('lrmix_cases_finished', 'gauge', 'Cases with an output', finished),
+                    ('lrmix_throughput', 'gauge', 'Cases finished per second, smoothed', self.rate or 0.0),
+                    ('lrmix_eta_seconds', 'gauge', 'Estimated seconds until every case is done', eta),
+            ):
+                if val is None:
+                    continue
+                f.write(f'# HELP {name} {help}\n# TYPE {name} {kind}\n')
+                f.write(f'{name}{{db="{os.path.abspath(self.db.path)}"}} {val}\n')
+        os.replace(tmp, self.metrics)
+
+    def report(self):
+        total, progressing, finished, eta = self.tick()
+        rate = f', {self.rate:.2f}/s, ETA {format_duration(eta)}' if self.rate is not None else ''
+        print(f'\x1b[1;32mRunning {progressing}, done {finished}/{total} ({100.0*finished/max(total, 1):.2f}%){rate}\x1b[m')
+        if self.metrics is not None:
+            self.write_metrics(total, progressing, finished, eta)
 
     def run(self):
-        while True:
-            if self.die.is_set():
-                break
-            total = self.db.total_cases()
-            progressing = self.db.progressing_cases()
-            finished = self.db.finished_cases()
-            print(f'\x1b[1;32mRunning {progressing}, done {finished}/{total} ({100.0*finished/total:.2f}%)\x1b[m')
-            time.sleep(self.interval)
-
-def run_batch(db, lrmix, jobs=None, java=None):
-    os.makedirs(TMP, exist_ok=True)
-    if jobs is None:
-        jobs = multiprocessing.cpu_count()
+        self.report()
+        while not self.die.wait(self.interval):
+            self.report()
+        if self.metrics is not None:
+            # Once more, so the file says we're done
+            self.write_metrics(*self.tick())
+
+BACKENDS = ('jar', 'native', 'check')
+
+class ExecutorDied(Exception):
+    pass
+
+def make_interface(lrmix, java=None, persistent=False, max_cases=None, backend='jar', jvm_args=(), cds=None, store='full'):
+    if backend == 'native':
+        import native
+        return native.NativeInterface(store=store)
+    kwargs = {'jvm_args': jvm_args, 'cds': cds, 'store': store}
+    if java is not None:
+        kwargs['java'] = java
+    if persistent:
+        intf = PersistentInterface(lrmix, max_cases=max_cases, **kwargs)
+    else:
+        intf = Interface(lrmix, **kwargs)
+    if backend == 'check':
+        import native
+        return CrossCheckInterface(native.NativeInterface(store=store), intf)
+    return intf
+
+def process_worker(path, intf_args, cache_args, exec_opts, failed, trace=None, locus_memo=0):
+    if trace is not None:
+        tracing.start()
+    db = Database(path)
+    cache = ResultCache(*cache_args) if cache_args is not None else None
+    intf = make_interface(*intf_args)
+    executor = Executor(db, intf, cache=cache, loci=LocusMemo(locus_memo) if locus_memo else None, **exec_opts)
+    try:
+        executor.run()
+    finally:
+        with failed.get_lock():
+            failed.value += len(executor.failed)
+        if cache is not None:
+            cache.close()
+        db.db.close()
+        if trace is not None:
+            tracing.save_part(trace, tracing.stop())
+
+def run_processes(db, intf_args, jobs, cache=None, profile=None, profile_workers=0, trace=None, locus_memo=0, **exec_opts):
+    '''Like run_batch, but with each executor in its own process holding its
+    own connection, so claims and commits only contend in SQLite itself
+    (and each its own LocusMemo).'''
+    cache_args = (cache.path, cache.max_bytes) if cache is not None else None
+    # Not fork: SQLite's internal locks may be held by our other threads
+    ctx = multiprocessing.get_context('spawn')
+    failed = ctx.Value('i', 0)
+    procs = [
+        ctx.Process(target=process_worker, args=(
+            db.path, intf_args, cache_args, dict(exec_opts, profile=profile if i < profile_workers else None), failed,
+            trace, locus_memo
+        ))
+        for i in range(jobs)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    died = sum(proc.exitcode != 0 for proc in procs)
+    if died:
+        raise ExecutorDied(f'{died} of {jobs} executor processes died')
+    return failed.value
+
+def run_async(db, lrmix, jobs, java=None, cache=None, timeout=None, profile=None, profile_workers=0, jvm_args=(), cds=None,
+              store='full', **exec_opts):
+    '''Like run_batch, but with `jobs` concurrent LRmix processes driven by
+    one AsyncExecutor.'''
+    kwargs = {'jvm_args': jvm_args, 'cds': cds, 'store': store}
+    if java is not None:
+        kwargs['java'] = java
+    intf = AsyncInterface(lrmix, timeout=timeout, **kwargs)
+    profile = profile if profile_workers else None
+    executor = AsyncExecutor(db, intf, jobs, cache=cache, profile=profile, store=store, **exec_opts)
+    asyncio.run(executor.run())
+    return len(executor.failed)
+
+def run_threads(db, intf_args, jobs, cache=None, profile=None, profile_workers=0, locus_memo=0, adaptive=None, **exec_opts):
+    '''Like run_batch, with an Executor thread per job. With `adaptive` (a
+    dict of Governor options), `jobs` is the most that run at once.'''
+    digests = FileDigests()
+    loci = LocusMemo(locus_memo) if locus_memo else None
+    governor = Governor(jobs, **adaptive) if adaptive is not None else None
     exec_threads = [None] * jobs
     for i in range(jobs):
-        intf = Interface(lrmix, java) if java is not None else Interface(lrmix)
-        exec_thread = Executor(db, intf)
+        intf = make_interface(*intf_args)
+        exec_thread = Executor(db, intf, cache=cache, digests=digests, loci=loci, governor=governor, index=i,
+                               profile=profile if i < profile_workers else None, **exec_opts)
         exec_threads[i] = exec_thread
-    obs_thread = Observer(db)
-    obs_thread.start()
+    if governor is not None:
+        governor.start()
     for thr in exec_threads:
         thr.start()
     for thr in exec_threads:
         thr.join()
-    obs_thread.die.set()
+    if governor is not None:
+        governor.die.set()
+    died = sum(thr.error is not None for thr in exec_threads)
+    if died:
+        raise ExecutorDied(f'{died} of {jobs} executors died')
+    return sum(len(thr.failed) for thr in exec_threads)
+
+def run_batch(db, lrmix, jobs=None, java=None, persistent=False, max_cases=None, backend='jar', cache=None, processes=False, aio=False, metrics=None,
+              trace=None, profile=None, profile_workers=1, jvm_args=(), cds=None, store='full', **exec_opts):
+    '''Run every unfinished case in `db`, reporting progress (and writing
+    it to `metrics`, see Observer). `exec_opts` are passed on to each
+    Executor (size, commit_rows, commit_delay, lease, budget, group), or to
+    run_async if `aio`. With `locus_memo` (a number of entries), executors
+    answer what they can from a LocusMemo. With `adaptive` (Governor
+    options, not for `processes`), a Governor decides how many of `jobs`
+    executors run, and `jobs` defaults to twice the CPUs.
+
+    With `trace`, phases of every executor are traced into that file (see
+    tracing) and summed up at the end. With `profile` (a directory), the
+    first `profile_workers` executors are run under cProfile.
+
+    LRmix's JVM gets `jvm_args`, and uses (or first creates) the class-data
+    sharing archive `cds` if that's given; see Interface.launcher.
+
+    Outputs are read keeping only what `store` says (see run.STORES), which
+    should be what `db` keeps of them.
+
+    Returns how many cases failed, which are left for a later run; raises
+    ExecutorDied if an executor itself did.'''
+    if jobs is None:
+        jobs = multiprocessing.cpu_count() * (2 if exec_opts.get('adaptive') else 1)
+    if profile is not None:
+        os.makedirs(profile, exist_ok=True)
+    else:
+        profile_workers = 0
+    if trace is not None:
+        tracing.start()
+    obs_thread = Observer(db, metrics=metrics)
+    obs_thread.start()
+    if store == 'overall' and exec_opts.get('locus_memo'):
+        # The memo needs every locus; the database drops them
+        store = 'loci'
+    try:
+        if aio:
+            return run_async(db, lrmix, jobs, java, cache, profile=profile, profile_workers=profile_workers, jvm_args=jvm_args,
+                      cds=cds, store=store, **exec_opts)
+        elif processes:
+            return run_processes(db, (lrmix, java, persistent, max_cases, backend, jvm_args, cds, store), jobs, cache, profile,
+                          profile_workers, trace, store=store, **exec_opts)
+        else:
+            return run_threads(db, (lrmix, java, persistent, max_cases, backend, jvm_args, cds, store), jobs, cache, profile,
+                        profile_workers, store=store, **exec_opts)
+    finally:
+        obs_thread.die.set()
+        obs_thread.join()
+        if trace is not None:
+            events = tracing.merge(trace, tracing.stop())
+            tracing.write(trace, events)
+            print_trace_summary(events)
+
+def print_trace_summary(events, out=sys.stderr):
+    phases = sorted(tracing.summary(events).items(), key=lambda kv: -kv[1][1])
+    print('Phase          count      total       mean', file=out)
+    for name, (n, total) in phases:
+        print(f'{name:12} {n:7} {total:9.3f}s {1000 * total / n:8.3f}ms', file=out)
+
+# Coordinator/worker mode, for running one database's cases on many
+# machines: `serve` owns the database and hands out claims over TCP, and each
+# `worker` runs executors against a RemoteDatabase in its place. Requests and
+# responses are single lines of JSON. Workers need the population and
+# evidence files at the same paths (a read-only share is fine); profiles
+# travel with the claimed rows. A worker that dies or loses its connection
+# simply stops renewing its leases, and its rows are claimed again once they
+# run out.
+#
+# Anyone who can connect can commit outputs and release claims, so the
+# coordinator only listens on this machine unless it's given a shared token
+# ($LRMIXINT_TOKEN), which workers then send with every request.
+
+PORT = 7462
+TOKEN_ENV = 'LRMIXINT_TOKEN'
+
+class RemoteError(Exception):
+    pass
+
+def parse_address(text):
+    '''(host, port) from HOST[:PORT], with an IPv6 host in brackets if a port
+    follows it ([::1]:7462). Raises ValueError if it's neither.'''
+    if text.startswith('['):
+        host, sep, rest = text[1:].partition(']')
+        if not sep or rest[:1] not in ('', ':'):
+            raise ValueError(f'bad address {text!r}, expected HOST[:PORT] or [HOST]:PORT')
+        port = rest[1:] if rest else None
+    elif text.count(':') == 1:
+        host, _, port = text.partition(':')
+    else:  # no port, or a bare IPv6 address
+        host, port = text, None
+    if port is None:
+        port = PORT
+    elif port.isdigit() and 0 < int(port) < 65536:
+        port = int(port)
+    else:
+        raise ValueError(f'bad port in address {text!r}')
+    return host or 'localhost', port
+
+class Coordinator(socketserver.ThreadingTCPServer):
+    '''Serves `db` to workers, a thread per connection.'''
+    daemon_threads = True
+    allow_reuse_address = True
+    OPS = ('claim', 'commit', 'renew', 'release', 'fail', 'next_claim', 'digests', 'counter')
+
+    def __init__(self, db, address, token=None):
+        self.db = db
+        self.token = token
+        self.encoder = JSONEncoder()
+        self.connections = 0
+        self.conn_lock = threading.Lock()
+        if ':' in address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(address, CoordinatorHandler)
+
+    def claim(self, key, size, lease, budget):
+        rows = self.db.claim_cases(key, size, lease, budget)
+        return {'rows': [[row.rowid, self.encoder.encode(row.case), row.files] for row in rows]}
+
+    def commit(self, items, timings):
+        pending = []
+        for rowid, output, inputs, started, finished in items:
+            row = Row(None, rowid, None)
+            row.inputs, row.started, row.finished = inputs, started, finished
+            pending.append((row, output))
+        self.db.set_outputs(pending, [tuple(t) for t in timings])
+        return {}
+
+    def renew(self, key, lease):
+        self.db.renew(key, lease)
+        return {}
+
+    def release(self, rowids):
+        self.db.release(rowids)
+        return {}
+
+    def fail(self, rowids):
+        self.db.fail(rowids)
+        return {}
+
+    def next_claim(self, key):
+        # In seconds, so the clocks needn't agree
+        return {'wait': self.db.next_claim(key)}
+
+    def digests(self, entries):
+        digests = FileDigests()
+        digests.load(entries)
+        self.db.save_digests(digests)
+        return {}
+
+    def counter(self, name):
+        if name not in Database.COUNTERS:
+            raise ValueError(f'no counter {name!r}')
+        return {'value': self.db.counter(name)}
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.conn_lock:
+            self.server.connections += 1
+        try:
+            for line in self.rfile:
+                req = json.loads(line)
+                op = req.pop('op', None)
+                token = req.pop('token', None)
+                try:
+                    if self.server.token is not None and not hmac.compare_digest(str(token), self.server.token):
+                        raise PermissionError('wrong token')
+                    if op not in Coordinator.OPS:
+                        raise ValueError(f'unknown request {op!r}')
+                    res = getattr(self.server, op)(**req)
+                except Exception as e:
+                    res = {'error': f'{type(e).__name__}: {e}'}
+                self.wfile.write(json.dumps(res).encode() + b'\n')
+        except ConnectionError:
+            pass
+        finally:
+            with self.server.conn_lock:
+                self.server.connections -= 1
+
+class RemoteDatabase:
+    '''What run_batch needs of a Database (but for --processes), forwarded
+    to a Coordinator over one connection shared by every executor.'''
+    # Outputs are cut down to the coordinator's store when it commits them
+    store = 'full'
+
+    def __init__(self, address, token=None):
+        self.path = f'{address[0]}:{address[1]}'
+        self.token = token
+        self.lock = threading.Lock()
+        self.sock = socket.create_connection(address)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+        self.decoder = JSONDecoder()
+
+    def request(self, op, **args):
+        with self.lock:
+            if self.token is not None:
+                args['token'] = self.token
+            self.wfile.write(json.dumps(dict(args, op=op)).encode() + b'\n')
+            self.wfile.flush()
+            line = self.rfile.readline()
+        if not line:
+            raise ConnectionError(f'{self.path} closed the connection')
+        res = json.loads(line)
+        if 'error' in res:
+            raise RemoteError(res['error'])
+        return res
+
+    def claim_cases(self, claim_key, size=64, lease=300, budget=60):
+        res = self.request('claim', key=claim_key, size=size, lease=lease, budget=budget)
+        return [Row(self.decoder.decode(case), rowid, files) for rowid, case, files in res['rows']]
+
+    def set_outputs(self, items, timings=()):
+        self.request('commit', items=[(row.rowid, output, row.inputs, row.started, row.finished) for row, output in items],
+                     timings=list(timings))
+
+    def renew(self, claim_key, lease=300):
+        self.request('renew', key=claim_key, lease=lease)
+
+    def release(self, rowids):
+        self.request('release', rowids=list(rowids))
+
+    def fail(self, rowids):
+        self.request('fail', rowids=list(rowids))
+
+    def next_claim(self, claim_key=None):
+        return self.request('next_claim', key=claim_key)['wait']
+
+    def save_digests(self, digests):
+        self.request('digests', entries=digests.entries())
+
+    def counter(self, name):
+        return self.request('counter', name=name)['value']
+
+    def total_cases(self):
+        return self.counter('total')
+
+    def progressing_cases(self):
+        return self.counter('claimed')
+
+    def finished_cases(self):
+        return self.counter('finished')
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+def serve(db, address, metrics=None, poll=1.0, token=None):
+    '''Coordinate workers until every case in `db` is finished (or failed)
+    and they have all disconnected. With `token`, requests without it are
+    refused.'''
+    db.schedule()
+    db.retry_failed()
+    db.db.commit()
+    server = Coordinator(db, address, token)
+    host, port = server.server_address[:2]
+    print(f'Serving {db.path} on {host}:{port}')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    obs_thread = Observer(db, metrics=metrics)
+    obs_thread.start()
+    try:
+        idle = False
+        while db.next_claim() is not None or server.connections:
+            if idle != (not server.connections):
+                idle = not server.connections
+                if idle:
+                    print(f'{db.total_cases() - db.finished_cases() - db.failed_cases()} cases left and no workers connected; waiting for '
+                          'workers (claims of lost ones are taken over once their leases run out)')
+            time.sleep(poll)
+    finally:
+        server.shutdown()
+        server.server_close()
+        obs_thread.die.set()
+        obs_thread.join()
+
+# Sharded databases, for when one SQLite file (and its one writer) is the
+# bottleneck: `prep_* --shards N` splits the cases over N databases next to
+# the one named, by a hash of the sample or of the population, and each
+# shard is then a database of its own that can be run, copied or backed up
+# independently. `run`, `status` and `extract` on the name fan out over the
+# shards, and `merge` puts them back together into the named file (which,
+# once it exists, is what the name refers to).
+
+SHARD_KEYS = ('sample', 'population')
+
+def shard_path(path, index, count):
+    root, ext = os.path.splitext(path)
+    return f'{root}.{index}-of-{count}{ext}'
+
+def find_shards(path):
+    '''The shards of `path` in order, or [] if it isn't sharded (or has been
+    merged).'''
+    if os.path.exists(path):
+        return []
+    root, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r'\.(\d+)-of-(\d+)' + re.escape(ext) + '$')
+    found = {}
+    for name in glob.glob(glob.escape(root) + '.*-of-*' + glob.escape(ext)):
+        m = pattern.match(os.path.basename(name))
+        if m:
+            found.setdefault(int(m[2]), set()).add(int(m[1]))
+    if not found:
+        return []
+    if len(found) > 1:
+        raise ValueError(f'{path} has shards of more than one split: {", ".join(map(str, sorted(found)))}')
+    (count, indices), = found.items()
+    missing = set(range(count)) - indices
+    if missing:
+        raise ValueError(f'{path} is missing shards {", ".join(map(str, sorted(missing)))} of {count}')
+    return [shard_path(path, i, count) for i in range(count)]
+
+def shard_of(value, count):
+    return zlib.crc32(value.encode()) % count
+
+def prep_shard(path, shard, sweep, siblings, prefix, label):
+    '''add_sweep() into one shard, `shard` being (key, index, count).'''
+    db = Database(path)
+    try:
+        split = db.get_meta('shard')
+        if split is not None and json.loads(split) != list(shard):
+            raise ValueError(f'{path} is shard {split}, not {list(shard)}')
+        db.set_meta('shard', json.dumps(list(shard)))
+        added = add_sweep(db, sweep, siblings, prefix, label, shard)
+        db.db.commit()
+        return added
+    finally:
+        db.db.close()
+
+def prep_shards(path, count, key, sweep, siblings, prefix='', label=None, jobs=None):
+    '''add_sweep() split over `count` shards of `path` by `key`, prepping up
+    to `jobs` of them at once, each in its own process (reading all of
+    `siblings` and keeping its own). `label` must pickle. Returns how many
+    cases were added.'''
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(jobs or multiprocessing.cpu_count(), mp_context=ctx) as pool:
+        futures = [pool.submit(prep_shard, shard_path(path, i, count), (key, i, count), sweep, siblings, prefix, label)
+                   for i in range(count)]
+        return sum(f.result() for f in futures)
+
+def shard_key(shard):
+    '''The (key, index, count) a shard was prepped with.'''
+    db = Database(shard)
+    try:
+        return tuple(json.loads(db.get_meta('shard')))
+    finally:
+        db.db.close()
+
+def prefetched(it, size=1000):
+    '''Iterate over `it` from a thread of its own, up to `size` items ahead.'''
+    q = queue.Queue(size)
+    done = object()
+    def fill():
+        try:
+            for item in it:
+                q.put(item)
+        finally:
+            q.put(done)
+    threading.Thread(target=fill, daemon=True).start()
+    while (item := q.get()) is not done:
+        yield item
 
-def row_to_contents(hdr, row, prefix=''):
+class Shards:
+    '''The shards of a database, with what status and extract (and
+    Observer) need of a Database asked of every shard in parallel.'''
+    def __init__(self, paths, readonly=False):
+        self.paths = paths
+        self.path = paths[0]
+        self.dbs = [Database(path, readonly) for path in paths]
+        self.pool = concurrent.futures.ThreadPoolExecutor(len(paths))
+
+    def fan_out(self, fn):
+        return list(self.pool.map(fn, self.dbs))
+
+    def total_cases(self):
+        return sum(self.fan_out(Database.total_cases))
+
+    def progressing_cases(self):
+        return sum(self.fan_out(Database.progressing_cases))
+
+    def finished_cases(self):
+        return sum(self.fan_out(Database.finished_cases))
+
+    def stale_cases(self):
+        return sum(self.fan_out(Database.stale_cases))
+
+    def failed_cases(self):
+        return sum(self.fan_out(Database.failed_cases))
+
+    def backfill(self):
+        return sum(self.fan_out(Database.backfill))
+
+    def populations(self):
+        return sorted(set().union(*self.fan_out(Database.populations)))
+
+    def iter_overall(self):
+        # Sharded by population, a contributor's rows are spread over
+        # shards; merging on the whole (label, sample, population) order
+        # each shard sorts by is what brings them back together
+        return heapq.merge(*(prefetched(db.iter_overall()) for db in self.dbs),
+                           key=lambda r: tuple('' if v is None else v for v in r[:3]))
+
+    def close(self):
+        self.pool.shutdown()
+        for db in self.dbs:
+            db.db.close()
+
+def sibling_profiles(path, prefix=''):
+    '''(sample name, profile contents saying SAMPLE instead of the name) for
+    each sibling in a Sibulator CSV, read as they're needed.'''
+    with open(path) as f:
+        rd = csv.reader(f)
+        header = next(rd)
+        for row in rd:
+            yield row_to_contents(header, row, prefix, SAMPLE)
+
+def add_sweep(db, sweep, siblings, prefix='', label=None, shard=None):
+    '''Add the cases of `sweep` for every sibling in the CSV `siblings`,
+    skipping those already in `db`; returns how many were added.
+
+    `label(point)` gives each point's props['case']. With `shard` (key,
+    index, count), only the cases of that shard are added.'''
+    key, index, count = shard or (None, 0, 1)
+    templates = []
+    for point in sweep.points():
+        if key == 'population' and shard_of(population_name(point['population']), count) != index:
+            continue
+        case = sweep.case(point, Profile('sib', sample_name = SAMPLE))
+        if label is not None:
+            case.props['case'] = label(point)
+        templates.append(db.add_template(case))
+    return db.add_templated(
+        (tid, name, {'sib': contents})
+        for name, contents in sibling_profiles(siblings, prefix)
+        if key != 'sample' or shard_of(name, count) == index
+        for tid in templates
+    )
+
+def fixed_label(case, point):
+    return case
+
+def point_label(case, point):
+    # Every parameter but the population (which has its own column), swept
+    # or not, so extending a sweep later leaves existing labels alone
+    return ' '.join([str(case)] + [f'{k}={v:g}' for k, v in point.items() if k != 'population'])
+
+def parse_axis(specs, type=float):
+    '''Values of a sweep axis from command-line specs, each either a comma
+    separated list or start:stop:count (count values, ends included).'''
+    vals = []
+    for spec in specs:
+        for part in spec.split(','):
+            if ':' in part:
+                start, stop, n = part.split(':')
+                start, stop, n = float(start), float(stop), int(n)
+                step = (stop - start) / (n - 1) if n > 1 else 0
+                # Rounded, so the same point spelled differently stays the same case
+                vals.extend(type(round(start + i * step, 12)) for i in range(n))
+            elif part.strip():
+                vals.append(type(part))
+    return list(dict.fromkeys(vals))
+
+def row_to_contents(hdr, row, prefix='', sample_name=None):
+    # sample_name, if given, is written into the CSV instead of the real name
     sio = io.StringIO()
     out = csv.DictWriter(sio, ['SampleName', 'Marker'] + [f'Allele{i+1}' for i in range(8)])
     out.writeheader()
@@ -199,7 +2175,7 @@ def row_to_contents(hdr, row, prefix=''):
     for locus, allele in zip(hdr[1:], row[1:]):
         loci.setdefault(locus, []).append(allele)
     for locus, alleles in loci.items():
-        row = {'SampleName': nm, 'Marker': locus}
+        row = {'SampleName': nm if sample_name is None else sample_name, 'Marker': locus}
         for idx, allele in enumerate(alleles):
             fa = float(allele)
             if fa == int(fa):
@@ -211,9 +2187,55 @@ def row_to_contents(hdr, row, prefix=''):
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Prepare, run, and export data from LRmix over multiple inputs')
-    parser.add_argument('dbfile', help='The database to operate on')
+    parser.add_argument('dbfile', help='The database to operate on (for worker, the coordinator\'s HOST[:PORT])')
+    parser.add_argument('-K', '--cache', default=os.environ.get('LRMIXINT_CACHE'), help='Result cache shared between databases (default $LRMIXINT_CACHE)')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Evict cached results beyond this many MiB')
     subparsers = parser.add_subparsers()
 
+    def open_cache(args):
+        if args.cache is None:
+            return None
+        return ResultCache(args.cache, args.cache_size << 20)
+
+    def open_database(args, readonly=False):
+        '''The database named, for commands that don't fan out over shards.'''
+        shards = find_shards(args.dbfile)
+        if shards:
+            print(f'{args.dbfile} is split into {len(shards)} shards; give one of them ({shards[0]}), or merge them first.')
+            exit(1)
+        return Database(args.dbfile, readonly)
+
+    def open_any(args):
+        '''The database named, or its shards, for reading only.'''
+        shards = find_shards(args.dbfile)
+        return Shards(shards, readonly=True) if shards else Database(args.dbfile, readonly=True)
+
+    def prep(args, sweep, label):
+        '''add_sweep() into the database named, or its shards (making them
+        with --shards); `label` must pickle.'''
+        shards = find_shards(args.dbfile)
+        if shards:
+            key, _, count = shard_key(shards[0])
+            if args.shards not in (None, count) or args.shard_by not in (None, key):
+                print(f'{args.dbfile} is already split into {count} shards by {key}.')
+                exit(1)
+        elif args.shards:
+            if os.path.exists(args.dbfile):
+                print(f'{args.dbfile} already exists, unsharded.')
+                exit(1)
+            key, count = args.shard_by or 'sample', args.shards
+        else:
+            db = Database(args.dbfile)
+            added = add_sweep(db, sweep, args.siblings, args.prefix, label)
+            db.db.commit()
+            return added
+        return prep_shards(args.dbfile, count, key, sweep, args.siblings, args.prefix, label, args.jobs)
+
+    def add_shard_arguments(p):
+        p.add_argument('--shards', type=int, help='Split the cases over this many databases next to the one named (see merge)')
+        p.add_argument('--shard-by', choices=SHARD_KEYS, help='What decides a case\'s shard (default sample)')
+        p.add_argument('-j', '--jobs', type=int, help='Prep up to this many shards at once (default: the number of CPUs)')
+
     def cmd_prep_siblings(args):
         if not args.population:
             print('At least one population file is required.')
@@ -224,33 +2246,14 @@ if __name__ == '__main__':
             parser.print_usage()
             exit(1)
 
-        db = Database(args.dbfile)
         pops = list(map(os.path.abspath, args.population))
         reps = list(map(os.path.abspath, args.replicate))
-        entries = 0
 
-        with open(args.siblings) as sibf:
-            header = None
-            for row in csv.reader(sibf):
-                if header is None:
-                    header = row
-                    continue
-                sampname, contents = row_to_contents(header, row, args.prefix)
-                for pop in pops:
-                    case = Case()\
-                        .with_population(pop)\
-                        .add_profiles(Profile('sib', sample_name = sampname))\
-                        .add_evidence(*reps)\
-                        .typical_hypotheses(sampname, args.contributors)
-                    for hyp in case.hyp:
-                        hyp.theta, hyp.drop_in, hyp.default_drop_out = args.theta, args.drop_in, args.drop_out
-                    case.rare = args.rare
-                    case.props['case'] = args.case
-                    dbrow = db.add_cases(case)[0]
-                    db.set_files(dbrow, {'sib': contents})
-                    entries += 1
-            
-        db.db.commit()
+        # One template per population; each sibling's profile is stored once
+        # and shared by all of them.
+        sweep = Sweep(reps, population=pops, contributors=[args.contributors], theta=[args.theta],
+                      drop_in=[args.drop_in], drop_out=[args.drop_out], rare=[args.rare])
+        entries = prep(args, sweep, functools.partial(fixed_label, args.case))
         print(f'Prepared {entries} runs.')
 
     parser_prep_siblings = subparsers.add_parser('prep_siblings')
@@ -265,37 +2268,284 @@ if __name__ == '__main__':
     parser_prep_siblings.add_argument('-T', '--theta', type=float, default=0.03, help='Theta correction to use')
     parser_prep_siblings.add_argument('-R', '--rare', type=float, default=0.0, help='Rare allele frequency to use')
     parser_prep_siblings.add_argument('--prefix', default='', help='Prefix this string to each sibling\'s sample identifier')
+    add_shard_arguments(parser_prep_siblings)
+
+    def cmd_prep_sweep(args):
+        if not args.population or not args.replicate:
+            print('At least one population and one replicate file are required.')
+            parser.print_usage()
+            exit(1)
+        axes = {
+            'population': list(map(os.path.abspath, args.population)),
+            'contributors': parse_axis(args.contributors, int),
+        }
+        # Same defaults as prep_siblings
+        for axis, default in (('theta', '0.03'), ('drop_in', '0.02'), ('drop_out', '0.05'), ('rare', '0')):
+            axes[axis] = parse_axis(getattr(args, axis) or [default])
+        sweep = Sweep(list(map(os.path.abspath, args.replicate)), **axes)
+        print(f'Sweeping {len(sweep)} points per sibling.')
+        entries = prep(args, sweep, functools.partial(point_label, args.case))
+        print(f'Prepared {entries} new runs.')
+
+    parser_prep_sweep = subparsers.add_parser('prep_sweep')
+    parser_prep_sweep.set_defaults(func=cmd_prep_sweep)
+    parser_prep_sweep.add_argument('-C', '--case', required=True, help='Case number to associate with this sweep (the parameters are appended to it)')
+    parser_prep_sweep.add_argument('-S', '--siblings', required=True, help='CSV of siblings prepared according to Sibulator format')
+    parser_prep_sweep.add_argument('-P', '--population', action='append', default=[], help='Population files (can be specified more than once)')
+    parser_prep_sweep.add_argument('-r', '--replicate', action='append', default=[], help='Replicate (evidence) file (can be specified more than once)')
+    # Axes: each can be given more than once, as a list (a,b,c) or a range (start:stop:count)
+    parser_prep_sweep.add_argument('-c', '--contributors', action='append', required=True, help='Numbers of contributors to the sample')
+    parser_prep_sweep.add_argument('-D', '--drop-in', action='append', help='Drop-ins (default 0.02)')
+    parser_prep_sweep.add_argument('-d', '--drop-out', action='append', help='Default drop-outs (default 0.05)')
+    parser_prep_sweep.add_argument('-T', '--theta', action='append', help='Theta corrections (default 0.03)')
+    parser_prep_sweep.add_argument('-R', '--rare', action='append', help='Rare allele frequencies (default 0)')
+    parser_prep_sweep.add_argument('--prefix', default='', help='Prefix this string to each sibling\'s sample identifier')
+    add_shard_arguments(parser_prep_sweep)
+
+    def resolve_java(args):
+        if args.java is not None and os.path.exists(os.path.abspath(args.java)):
+            return os.path.abspath(args.java)
+        # Otherwise, it might just be in $PATH--leave it.
+        return args.java
+
+    def launch_options(args, directory, java):
+        '''JVM arguments, and where the CDS archive goes if --cds.'''
+        jvm_args = launch_args(args.launch_profile, args.heap, args.jvm_arg)
+        cds = cds_archive(directory, args.lrmix, java or 'java') if args.cds else None
+        return jvm_args, cds
+
+    def run_cases(args, db, directory):
+        if args.lrmix is None and args.backend != 'native':
+            print(f'The {args.backend} backend requires --lrmix.')
+            parser.print_usage()
+            exit(1)
+        lrmix = args.lrmix and os.path.abspath(args.lrmix)
+        java = resolve_java(args)
+        jvm_args, cds = launch_options(args, directory, java) if lrmix else ((), None)
+        if args.asyncio and (args.backend != 'jar' or args.persistent or args.processes or args.group_cases > 1 or args.locus_memo
+                             or args.adaptive):
+            print('--asyncio only runs the jar backend, one process per case, in this process.')
+            parser.print_usage()
+            exit(1)
+        if args.adaptive and args.processes:
+            print('--adaptive needs every executor in this process.')
+            parser.print_usage()
+            exit(1)
+        cache = open_cache(args)
+        opts = {'timeout': args.timeout, 'prefetch': args.prefetch} if args.asyncio else {'group': args.group_cases, 'locus_memo': args.locus_memo}
+        if args.adaptive:
+            opts['adaptive'] = {'min_jobs': args.min_jobs, 'reserve': args.memory_reserve << 20,
+                                'case_memory': args.case_memory << 20}
+        try:
+            return run_batch(db, lrmix, args.jobs, java, args.persistent, args.worker_cases, args.backend, cache, args.processes,
+                             args.asyncio, args.metrics, args.trace, args.profile, args.profile_workers, size=args.claim_size, commit_rows=args.commit_rows, commit_delay=args.commit_delay,
+                             lease=args.lease, budget=args.claim_budget, jvm_args=jvm_args, cds=cds, store=args.store or db.store,
+                             **opts)
+        except ExecutorDied as e:
+            print(f'{e}; their claims will be taken over once their leases run out.')
+            exit(1)
+
+    def run_shards(args, shards):
+        '''Run the shards, each in a `run` process of its own with the same
+        arguments, sharing out --jobs between them: with fewer jobs than
+        shards, that many shards run at a time with one job each.'''
+        if args.metrics or args.trace or args.profile:
+            print('--metrics, --trace and --profile need running the shards one by one.')
+            parser.print_usage()
+            exit(1)
+        jobs = args.jobs or multiprocessing.cpu_count() * (2 if args.adaptive else 1)
+        slots = min(jobs, len(shards))
+        argv = sys.argv[1:]
+        at = argv.index(args.dbfile)
+        todo = queue.Queue()
+        for shard in shards:
+            todo.put(shard)
+        failed = []
+
+        def run_slot(share):
+            while True:
+                try:
+                    shard = todo.get_nowait()
+                except queue.Empty:
+                    return
+                # The last --jobs given wins
+                cmd = [sys.executable, os.path.abspath(__file__)] + argv[:at] + [shard] + argv[at + 1:] + ['--jobs', str(share)]
+                if subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode != 0:
+                    failed.append(shard)
+
+        threads = [threading.Thread(target=run_slot, args=(jobs // slots + (i < jobs % slots),)) for i in range(slots)]
+        db = Shards(shards, readonly=True)
+        obs_thread = Observer(db)
+        obs_thread.start()
+        try:
+            for thr in threads:
+                thr.start()
+            for thr in threads:
+                thr.join()
+        finally:
+            obs_thread.die.set()
+            obs_thread.join()
+            db.close()
+        if failed:
+            print(f'Running {", ".join(sorted(failed))} failed.')
+            exit(1)
+
+    def done(failed):
+        if failed:
+            print(f'Done, but {failed} cases failed; they are left for the next run.')
+            exit(1)
+        print('Done.')
 
     def cmd_run(args):
+        shards = find_shards(args.dbfile)
+        if shards:
+            run_shards(args, shards)
+            print('Done.')
+            return
         db = Database(args.dbfile)
-        lrmix = os.path.abspath(args.lrmix)
-        java = None
-        if args.java is not None:
-            java = args.java
-            if os.path.exists(os.path.abspath(java)):
-                java = os.path.abspath(java)
-                # Otherwise, it might just be in $PATH--leave it.
-        run_batch(db, lrmix, args.jobs, java)
+        if args.store is not None:
+            db.set_store(args.store)
+        db.schedule()
+        db.retry_failed()
+        failed = run_cases(args, db, os.path.dirname(os.path.abspath(args.dbfile)))
         db.db.commit()
-        print('Done.')
+        done(failed)
 
     parser_run = subparsers.add_parser('run')
     parser_run.set_defaults(func=cmd_run)
-    parser_run.add_argument('-L', '--lrmix', required=True, help='Location of the instrumented LRmix JAR')
-    parser_run.add_argument('-j', '--jobs', type=int, help='Number of concurrent jobs to run')
-    parser_run.add_argument('-J', '--java', help='Alternative JVM executable')
+    def add_run_arguments(p):
+        p.add_argument('-L', '--lrmix', help='Location of the instrumented LRmix JAR (not needed for the native backend)')
+        p.add_argument('-j', '--jobs', type=int, help='Number of concurrent jobs to run')
+        p.add_argument('-J', '--java', help='Alternative JVM executable')
+        p.add_argument('--persistent', action='store_true', help='Keep one long-lived LRmix worker per job instead of starting a JVM per case')
+        p.add_argument('--worker-cases', type=int, help='Restart persistent workers after this many cases')
+        p.add_argument('-p', '--processes', action='store_true', help='Run each job in its own process with its own connection')
+        p.add_argument('--claim-size', type=int, default=64, help='Number of cases each job claims at a time')
+        p.add_argument('--claim-budget', type=float, default=60, help='Stop adding cases to a claim once it holds about this many estimated seconds of work')
+        p.add_argument('--commit-rows', type=int, default=64, help='Commit finished outputs once this many are pending')
+        p.add_argument('--commit-delay', type=float, default=5.0, help='...or once the oldest has waited this many seconds')
+        p.add_argument('--lease', type=float, default=300, help='Seconds a claim stays valid without a heartbeat before others may take it over')
+        p.add_argument('-G', '--group-cases', type=int, default=1, help='Run up to this many cases sharing population and evidence per LRmix invocation (needs the --batch driver)')
+        p.add_argument('-m', '--locus-memo', type=int, nargs='?', const=1 << 18, default=0, help='Reuse per-locus LRs between siblings, remembering up to this many (default 262144) per process, and only run LRmix for loci not seen yet')
+        p.add_argument('-a', '--adaptive', action='store_true', help='Vary the number of running jobs with CPU and memory use (-j becomes the maximum, by default twice the CPUs), and hold back cases that won\'t fit in memory')
+        p.add_argument('--min-jobs', type=int, default=1, help='With --adaptive, never run fewer jobs than this')
+        p.add_argument('--memory-reserve', type=int, default=1024, help='With --adaptive, MiB of memory to leave available')
+        p.add_argument('--case-memory', type=int, default=1024, help='With --adaptive, MiB a case is expected to take until one with as many unknowns has been seen')
+        p.add_argument('-A', '--asyncio', action='store_true', help='Drive all jobs from one asyncio event loop instead of a thread each (so -j can be in the hundreds)')
+        p.add_argument('--timeout', type=float, help='With --asyncio, kill cases running longer than this many seconds (they are retried by a later run)')
+        p.add_argument('--prefetch', type=int, help='With --asyncio, keep at most this many claimed cases queued (default: twice --jobs)')
+        p.add_argument('--trace', help='Record the phases of each case into this Chrome trace (JSON) file')
+        p.add_argument('--profile', help='Write cProfile output of some executors into this directory')
+        p.add_argument('--profile-workers', type=int, default=1, help='With --profile, how many executors to profile')
+        p.add_argument('-M', '--metrics', help='Keep progress and throughput in this file, in the Prometheus text format')
+        p.add_argument('-B', '--backend', choices=BACKENDS, default='jar', help='Compute LRs with the JAR, in-process with NumPy, or with both and compare (check)')
+        p.add_argument('--launch-profile', choices=LAUNCH_PROFILES, default='plain', help='JVM tuning: short for a JVM per case (C1 only, serial GC), long for --persistent')
+        p.add_argument('--heap', help='Maximum JVM heap size, as for -Xmx (e.g. 512m)')
+        p.add_argument('--jvm-arg', action='append', default=[], help='Extra JVM option (can be specified more than once)')
+        p.add_argument('--store', choices=STORES, help='What to keep of outputs from now on: everything, the LRs of each locus, or only the overall LRs (default: what the database keeps, full at first). Workers only read this much, and the coordinator keeps what its database does')
+        p.add_argument('--cds', action='store_true', help='Start LRmix from a class-data sharing archive kept next to the database (in the current directory for workers), created by the first launch')
+
+    add_run_arguments(parser_run)
+
+    def cmd_refresh(args):
+        db = open_database(args)
+        checked, stale, missing = db.refresh(dry_run=args.dry_run)
+        for path in missing:
+            print(f'Missing input file {path}; its cases were left alone')
+        print(f'{"Would invalidate" if args.dry_run else "Invalidated"} {stale} of {checked} results checked.')
+        if stale and not args.dry_run:
+            cmd_run(args)
+
+    parser_refresh = subparsers.add_parser('refresh')
+    parser_refresh.set_defaults(func=cmd_refresh)
+    parser_refresh.add_argument('-n', '--dry-run', action='store_true', help='Only report what changed')
+    add_run_arguments(parser_refresh)
+
+    def cmd_serve(args):
+        try:
+            address = parse_address(args.listen)
+        except ValueError as e:
+            parser_serve.error(str(e))
+        token = os.environ.get(TOKEN_ENV) or None
+        if token is None and address[0] not in ('localhost', '127.0.0.1', '::1'):
+            print(f'Listening beyond this machine needs a shared token in ${TOKEN_ENV} (for the workers too).')
+            exit(1)
+        db = open_database(args)
+        serve(db, address, args.metrics, token=token)
+        print('Done.')
+
+    parser_serve = subparsers.add_parser('serve')
+    parser_serve.set_defaults(func=cmd_serve)
+    parser_serve.add_argument('-l', '--listen', default=f'127.0.0.1:{PORT}', help=f'Address to take workers\' connections on (default this machine only, port {PORT}; any other needs ${TOKEN_ENV} set)')
+    parser_serve.add_argument('-M', '--metrics', help='Keep progress and throughput in this file, in the Prometheus text format')
+
+    def cmd_worker(args):
+        if args.processes or args.metrics:
+            print('Workers run their jobs in one process, and only the coordinator keeps metrics.')
+            parser.print_usage()
+            exit(1)
+        try:
+            address = parse_address(args.dbfile)
+        except ValueError as e:
+            parser_worker.error(str(e))
+        db = RemoteDatabase(address, os.environ.get(TOKEN_ENV) or None)
+        try:
+            failed = run_cases(args, db, os.getcwd())
+        finally:
+            db.close()
+        done(failed)
+
+    # dbfile is the coordinator's HOST[:PORT] here
+    parser_worker = subparsers.add_parser('worker')
+    parser_worker.set_defaults(func=cmd_worker)
+    add_run_arguments(parser_worker)
+
+    def cmd_launch_latency(args):
+        if args.lrmix is None:
+            print('Measuring launches requires --lrmix.')
+            parser.print_usage()
+            exit(1)
+        db = open_database(args)
+        row = next((row for row, _ in db._iter_rows(chunk=1)), None)
+        if row is None:
+            print('No cases to launch.')
+            exit(1)
+        lrmix, java = os.path.abspath(args.lrmix), resolve_java(args)
+        args.cds = True
+        jvm_args, cds = launch_options(args, os.path.dirname(os.path.abspath(args.dbfile)), java)
+        staging = Staging()
+        try:
+            with staging.files(row.files or {}) as resolve:
+                for what, archive in (('without', None), ('with', cds)):
+                    intf = Interface(lrmix, java or 'java', jvm_args, archive)
+                    if archive is not None and not os.path.exists(archive):
+                        intf.launch_latency(row.case, resolve)
+                        if not os.path.exists(archive):
+                            print(f'Could not create a class-data sharing archive at {archive}.')
+                            break
+                    times = sorted(intf.launch_latency(row.case, resolve) for _ in range(args.launches))
+                    print(f'Spawn to first output {what} archive: median {1000 * times[len(times) // 2]:.1f} ms, '
+                          f'min {1000 * times[0]:.1f} ms, max {1000 * times[-1]:.1f} ms over {len(times)} launches')
+        finally:
+            staging.close()
+
+    parser_launch_latency = subparsers.add_parser('launch_latency')
+    parser_launch_latency.set_defaults(func=cmd_launch_latency)
+    parser_launch_latency.add_argument('-n', '--launches', type=int, default=5, help='Launches to time each way')
+    add_run_arguments(parser_launch_latency)
 
     def cmd_clean(args):
-        db = Database(args.dbfile)
-        res = db.clean()
+        db = open_database(args)
+        res = db.clean(args.all)
         print(f'Cleaned {res} entries')
         cmd_status(args, db)
 
     parser_clean = subparsers.add_parser('clean')
     parser_clean.set_defaults(func=cmd_clean)
+    parser_clean.add_argument('-a', '--all', action='store_true', help='Release live claims too, not just expired ones')
 
     def cmd_reset(args):
-        db = Database(args.dbfile)
+        db = open_database(args)
         res = db.reset()
         print(f'Reset {res} entries')
         cmd_status(args, db)
@@ -303,46 +2553,149 @@ if __name__ == '__main__':
     parser_reset = subparsers.add_parser('reset')
     parser_reset.set_defaults(func=cmd_reset)
 
+    def cmd_migrate(args):
+        db = open_database(args)
+        cases = db.convert_cases() if db.case_format != codec.VERSION else 0
+        outputs = db.convert_outputs()
+        if not cases and not outputs:
+            print('Already up to date.')
+            return
+        print(f'Converted {cases} cases and {outputs} outputs.')
+        if args.vacuum:
+            db.db.execute('VACUUM')
+
+    parser_migrate = subparsers.add_parser('migrate')
+    parser_migrate.set_defaults(func=cmd_migrate)
+    parser_migrate.add_argument('--vacuum', action='store_true', help='Reclaim the space freed afterwards')
+
     def cmd_status(args, db=None):
         if db is None:
-            db = Database(args.dbfile)
+            db = open_any(args)
         t, p, f = db.total_cases(), db.progressing_cases(), db.finished_cases()
-        print(f'Presently running {p}, done {f}/{t} ({100.0*f/t:.2f}%)')
+        print(f'Presently running {p}, done {f}/{t} ({100.0*f/max(t, 1):.2f}%)')
+        failed = db.failed_cases()
+        if failed:
+            print(f'{failed} cases failed in the last run, and will be tried again by the next one')
+        stale = db.stale_cases()
+        if stale:
+            print(f'{stale} claims have expired and will be taken over by the next run')
+        cache = open_cache(args)
+        if cache is not None:
+            st = cache.stats()
+            looked = st['hits'] + st['misses']
+            rate = 100.0 * st['hits'] / looked if looked else 0.0
+            print(f'Cache: {st["hits"]} hits, {st["misses"]} misses ({rate:.2f}% hit rate), {st["entries"]} entries, {st["bytes"] / (1 << 20):.1f} MiB')
 
     parser_status = subparsers.add_parser('status')
     parser_status.set_defaults(func=cmd_status)
 
+    def cmd_stats(args):
+        db = open_database(args, readonly=True)
+        total, finished = db.total_cases(), db.finished_cases()
+        lats = db.latencies()
+        secs = [s for _, s in lats]
+        print(f'Done {finished}/{total}; {len(secs)} ran, {finished - len(secs)} came from the cache (or predate timing).')
+        if secs:
+            print('Case latency: ' + ', '.join(
+                f'p{q} {percentile(secs, q):.3f}s' for q in (50, 95, 99)
+            ) + f', max {secs[-1]:.3f}s')
+
+        print('\nPer worker:')
+        for worker, n, first, last in db.worker_rates():
+            span = (last - first) if first is not None and last is not None else 0
+            rate = f'{n / span:.2f}/s' if span > 0 else 'n/a'
+            print(f'  {worker}: {n} cases, {rate}')
+
+        now = time.time()
+        buckets = db.throughput(args.bucket, now - args.bucket * args.buckets)
+        if buckets:
+            print(f'\nThroughput (per {args.bucket:g}s):')
+            peak = max(n for _, n in buckets)
+            for t, n in buckets:
+                bar = '#' * max(1, round(40 * n / peak))
+                print(f'  {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))} {n:7} {bar}')
+        recent = sum(n for t, n in db.throughput(args.window, now - args.window)) / args.window
+        eta = (total - finished) / recent if recent else None
+        print(f'\nRecent rate {recent:.2f}/s over {args.window:g}s, ETA {format_duration(eta) if total > finished else "done"}')
+
+        by_shape = {}
+        for shape, sec in lats:
+            by_shape.setdefault(shape, []).append(sec)
+        if by_shape:
+            print('\nBy shape (unknowns Hp,Hd, replicates, profiles):')
+            for shape, vals in sorted(by_shape.items(), key=lambda kv: -percentile(kv[1], 95)):
+                print(f'  {shape}: {len(vals)} cases, mean {sum(vals) / len(vals):.3f}s, p95 {percentile(vals, 95):.3f}s')
+        slow = db.slowest(args.outliers)
+        if slow:
+            print('\nSlowest cases:')
+            for rowid, label, sample, pop, shape, sec in slow:
+                print(f'  #{rowid} {sec:.3f}s: case {label}, {sample}, {population_name(pop or "")}, shape {shape}')
+
+    parser_stats = subparsers.add_parser('stats')
+    parser_stats.set_defaults(func=cmd_stats)
+    parser_stats.add_argument('--bucket', type=float, default=60, help='Seconds per throughput bucket')
+    parser_stats.add_argument('--buckets', type=int, default=30, help='Show this many recent buckets')
+    parser_stats.add_argument('--window', type=float, default=600, help='Seconds of recent commits the ETA is based on')
+    parser_stats.add_argument('--outliers', type=int, default=10, help='Show this many of the slowest cases')
+
     def cmd_extract(args):
-        db = Database(args.dbfile)
-        pops = set()
-        contrs = {}
-        for case, data in db.iter_results():
-            pop = os.path.basename(case.hyp.p.population).partition('_')[0]
-            contr = next(iter(case.profiles.keys()))
-            case = case.props['case']
-            for row in data:
-                if row['Locus'] == '_OVERALL_':
-                    pops.add(pop)
-                    contrs.setdefault((case, contr), {})[pop] = float(row['LR'])
+        db = open_any(args)
+        db.backfill()
+        # Every population up front (even those without results yet), so we
+        # can write rows as they come and the columns stay stable while a
+        # batch is still running.
+        pops = db.populations()
+        rows = db.iter_overall()
+        if not args.quiet:
+            rows = progress(rows, db.finished_cases(), 'Extracted')
         with (
                 open(args.output, 'w')
                 if args.output is not None else
                 contextlib.nullcontext(sys.stdout)
         ) as fo:
-            out = csv.DictWriter(fo, ['Case', 'Contributor'] + list(pops))
+            out = csv.DictWriter(fo, ['Case', 'Contributor'] + pops)
             out.writeheader()
-            for key, lrs in contrs.items():
-                case, contr = key
+            for (case, contr), lrs in pivot_overall(rows):
                 out.writerow({'Case': case, 'Contributor': contr, **lrs})
             fo.flush()
 
     parser_extract = subparsers.add_parser('extract')
     parser_extract.set_defaults(func=cmd_extract)
     parser_extract.add_argument('-o', '--output', help='Write to this file (instead of stdout)')
+    parser_extract.add_argument('-q', '--quiet', action='store_true', help='Don\'t report progress on stderr')
+
+    def cmd_merge(args):
+        sources = args.source or find_shards(args.dbfile)
+        if not sources:
+            print(f'Nothing to merge into {args.dbfile}.')
+            parser.print_usage()
+            exit(1)
+        db = Database(args.dbfile)
+        total = 0
+        for path in sources:
+            count = db.merge(path)
+            print(f'Merged {count} cases from {path}')
+            total += count
+        if args.remove:
+            for path in sources:
+                for name in (path, path + '-wal', path + '-shm'):
+                    if os.path.exists(name):
+                        os.unlink(name)
+        print(f'Merged {total} cases from {len(sources)} databases.')
+        cmd_status(args, db)
+
+    parser_merge = subparsers.add_parser('merge')
+    parser_merge.set_defaults(func=cmd_merge)
+    parser_merge.add_argument('source', nargs='*', help='Databases to copy cases from (default: the shards of the one named)')
+    parser_merge.add_argument('--remove', action='store_true', help='Delete the sources once they\'re merged')
 
     args = parser.parse_args()
     if not hasattr(args, 'func') or args.func is None:
         print('No valid command.')
         parser.print_usage()
         exit(1)
-    args.func(args)
+    try:
+        args.func(args)
+    except ReadOnlyFormat as e:
+        print(e, file=sys.stderr)
+        exit(1)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Benchmarks of batch.py's own overhead, with fake_lrmix.py standing in for
+# the JAR. Each run appends a record to a JSON-lines results file and is
+# compared against the last record with the same settings, so regressions
+# between versions stand out.
+#
+#   python bench.py                        # 10k rows, jobs 1,2,4,8
+#   python bench.py --rows 10k,1M,10M      # the big ones take a while
+#
+# Measured per database size: prep rate, claim rate, database bytes per case
+# (prepped, and with outputs) and extract time. End to end cases/sec against
+# --jobs is measured once, on --e2e-cases rows, with FAKE_LRMIX_DELAY set to
+# --delay.
+
+import os, sys, io, csv, json, time, random, argparse, tempfile, contextlib, subprocess, platform
+
+import batch
+from batch import Database, Row
+from fake_lrmix import DEFAULT_LOCI
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUB = os.path.join(HERE, 'fake_lrmix.py')
+ALLELES = [str(a) for a in range(8, 20)]
+
+def parse_count(text):
+    mult = {'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+    return int(float(text[:-1]) * mult[text[-1]]) if text[-1] in mult else int(text)
+
+def make_inputs(d, pops=2, seed=1):
+    '''Populations and replicates for LOCI, in d; returns their paths.'''
+    rnd = random.Random(seed)
+    paths = []
+    for p in range(pops):
+        path = os.path.join(d, f'Pop{p}_FST_Frequencies.csv')
+        with open(path, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(['Allele'] + DEFAULT_LOCI)
+            for a in ALLELES:
+                out.writerow([a] + [f'{rnd.uniform(0.01, 0.15):.4f}' for _ in DEFAULT_LOCI])
+        paths.append(path)
+    reps = []
+    for r in range(2):
+        path = os.path.join(d, f'REP{r + 1}.csv')
+        with open(path, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(['SampleName', 'Marker'] + [f'Allele{i + 1}' for i in range(8)])
+            for locus in DEFAULT_LOCI:
+                alleles = sorted(rnd.sample(ALLELES, 4), key=int)
+                out.writerow([f'REP{r + 1}', locus] + alleles + [''] * 4)
+        reps.append(path)
+    return paths, reps
+
+def make_siblings(path, n, seed=2):
+    rnd = random.Random(seed)
+    with open(path, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(['Name'] + [locus for locus in DEFAULT_LOCI for _ in range(2)])
+        for i in range(n):
+            out.writerow([f'S{i}'] + [f'{rnd.choice(ALLELES)}.0' for _ in range(2 * len(DEFAULT_LOCI))])
+
+def fake_outputs(n=100, seed=3):
+    '''Outputs shaped like LRmix's, to fill big databases without running.'''
+    rnd = random.Random(seed)
+    outs = []
+    for _ in range(n):
+        rows, total = [], 0.0
+        for locus in DEFAULT_LOCI:
+            lr10 = rnd.uniform(-2, 2)
+            hd = 10.0 ** -rnd.randint(3, 7)
+            rows.append({'Locus': locus, 'Hp': repr(hd * 10 ** lr10), 'Hd': repr(hd),
+                         'LR': repr(10 ** lr10), 'LRLog10': repr(lr10)})
+            total += lr10
+        rows.append({'Locus': '_OVERALL_', 'Hp': '', 'Hd': '', 'LR': repr(10 ** total), 'LRLog10': repr(total)})
+        outs.append(rows)
+    return outs
+
+def prep(path, d, rows, pops, reps):
+    db = Database(path)
+    sibs = os.path.join(d, 'siblings.csv')
+    make_siblings(sibs, -(-rows // len(pops)))
+    sweep = batch.Sweep(reps, population=pops, contributors=[2], theta=[0.03], drop_in=[0.02],
+                        drop_out=[0.05], rare=[0.0])
+    start = time.perf_counter()
+    added = batch.add_sweep(db, sweep, sibs, label=lambda point: 'bench')
+    return db, added, time.perf_counter() - start
+
+def bench_claims(db, seconds):
+    key = batch.claim_key()
+    claims = rows = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        got = db.claim_cases(key, 64, budget=float('inf'))
+        if not got:
+            break
+        claims += 1
+        rows += len(got)
+    elapsed = time.perf_counter() - start
+    db.clean(everything=True)
+    return claims / elapsed, rows / elapsed
+
+def fill_outputs(db, chunk=10000):
+    outs = fake_outputs()
+    last = 0
+    while True:
+        ids = [r for r, in db.db.execute('SELECT rowid FROM cases WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                         (last, chunk))]
+        if not ids:
+            break
+        db.set_outputs([(Row(None, rowid, None), outs[rowid % len(outs)]) for rowid in ids])
+        last = ids[-1]
+
+def bench_extract(path):
+    # As `batch.py extract` does it, but into nothing
+    db = Database(path)
+    start = time.perf_counter()
+    pops = db.populations()
+    out = csv.DictWriter(open(os.devnull, 'w'), ['Case', 'Contributor'] + pops)
+    for (case, contr), lrs in batch.pivot_overall(db.iter_overall()):
+        out.writerow({'Case': case, 'Contributor': contr, **lrs})
+    return time.perf_counter() - start
+
+def bench_size(rows, args):
+    res = {}
+    with tempfile.TemporaryDirectory(dir=args.tmp) as d:
+        pops, reps = make_inputs(d)
+        path = os.path.join(d, 'bench.db')
+        db, added, secs = prep(path, d, rows, pops, reps)
+        res['prep_rows_per_s'] = added / secs
+        # Otherwise the rows are still in bench.db-wal
+        db.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        res['bytes_per_case_prepped'] = os.path.getsize(path) / added
+        res['claims_per_s'], res['claimed_rows_per_s'] = bench_claims(db, args.claim_seconds)
+        fill_outputs(db)
+        db.db.close()
+        res['bytes_per_case_done'] = os.path.getsize(path) / added
+        res['extract_s'] = bench_extract(path)
+    return res
+
+def bench_e2e(args):
+    res = {}
+    env = {'FAKE_LRMIX_DELAY': str(args.delay)}
+    with tempfile.TemporaryDirectory(dir=args.tmp) as d:
+        pops, reps = make_inputs(d)
+        path = os.path.join(d, 'e2e.db')
+        db, _, _ = prep(path, d, args.e2e_cases, pops, reps)
+        old = {k: os.environ.get(k) for k in env}
+        os.environ.update(env)
+        try:
+            for jobs in args.jobs:
+                db.reset()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    batch.run_batch(db, 'stub.jar', jobs, STUB, group=args.group)
+                res[f'cases_per_s_j{jobs}'] = db.finished_cases() / (time.perf_counter() - start)
+        finally:
+            for k, v in old.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+    return res
+
+def revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Metrics (less any @rows) where lower is better; for the rest, rates, higher is
+LOWER_IS_BETTER = {'bytes_per_case_prepped', 'bytes_per_case_done', 'extract_s'}
+
+def compare(record, previous, threshold):
+    worse_if_higher = lambda name: name.split('@')[0] in LOWER_IS_BETTER
+    for name, val in record['results'].items():
+        old = previous['results'].get(name) if previous else None
+        line = f'{name:32} {val:14.3f}'
+        if old:
+            change = (val - old) / old
+            bad = change > threshold if worse_if_higher(name) else change < -threshold
+            line += f'  {100 * change:+7.1f}% vs {previous["revision"]}' + ('  REGRESSION' if bad else '')
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark batch.py with a stub LRmix')
+    parser.add_argument('--rows', default='10k', help='Database sizes to measure, e.g. 10k,1M,10M')
+    parser.add_argument('--jobs', default='1,2,4,8', help='--jobs values to measure end to end')
+    parser.add_argument('--e2e-cases', type=int, default=400, help='Cases per end-to-end run')
+    parser.add_argument('--delay', type=float, default=0.05, help='Seconds the stub takes per case (FAKE_LRMIX_DELAY)')
+    parser.add_argument('-G', '--group', type=int, default=1, help='Cases per LRmix invocation end to end')
+    parser.add_argument('--claim-seconds', type=float, default=5.0, help='Measure claims for at most this long')
+    parser.add_argument('--tmp', help='Where to put the scratch databases')
+    parser.add_argument('-o', '--results', default=os.path.join(HERE, 'bench_results.jsonl'), help='Results file to append to')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Flag changes worse than this fraction')
+    args = parser.parse_args()
+    args.jobs = [int(j) for j in args.jobs.split(',')]
+
+    config = {'rows': args.rows, 'jobs': args.jobs, 'e2e_cases': args.e2e_cases, 'delay': args.delay,
+              'group': args.group}
+    results = {}
+    for rows in map(parse_count, args.rows.split(',')):
+        print(f'Measuring {rows} rows...', file=sys.stderr)
+        for name, val in bench_size(rows, args).items():
+            results[f'{name}@{rows}'] = val
+    print('Measuring end to end...', file=sys.stderr)
+    results.update(bench_e2e(args))
+
+    record = {'time': time.time(), 'revision': revision(), 'python': platform.python_version(),
+              'sqlite': batch.sqlite3.sqlite_version, 'config': config, 'results': results}
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec.get('config') == config:
+                    previous = rec
+    compare(record, previous, args.threshold)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + '\n')
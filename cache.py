@@ -0,0 +1,114 @@
+import sqlite3, json, threading, hashlib, os, time
+
+class FileDigests:
+    '''SHA-256 of files on disk, memoized until their mtime or size changes.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.memo = {}  # path -> ((mtime, size), digest)
+
+    def __call__(self, path):
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            ent = self.memo.get(path)
+        if ent is not None and ent[0] == stamp:
+            return ent[1]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        with self.lock:
+            self.memo[path] = (stamp, digest)
+        return digest
+
+    def load(self, entries):
+        '''Seed from (path, mtime_ns, size, digest) entries, e.g. saved by an
+        earlier run, so unchanged files needn't be hashed again.'''
+        with self.lock:
+            for path, mtime, size, digest in entries:
+                self.memo.setdefault(path, ((mtime, size), digest))
+
+    def entries(self):
+        with self.lock:
+            return [(path, *stamp, digest) for path, (stamp, digest) in self.memo.items()]
+
+class ResultCache:
+    '''LRmix outputs keyed by case fingerprint, in an SQLite file that can be
+    shared between databases (and processes).
+
+    Outputs (lists of rows) are kept as JSON text. Entries are evicted
+    least-recently-used first once their total size goes over `max_bytes`.
+    Hits and misses are counted in the file itself, so they add up across
+    every run using it.'''
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                output TEXT,
+                size INTEGER,
+                used REAL
+            );
+
+            CREATE INDEX IF NOT EXISTS results_used ON results (used);
+
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            );
+
+            INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('bytes', 0);
+        ''')
+        self.db.commit()
+
+    def _bump(self, name, by=1):
+        self.db.execute('UPDATE stats SET value=value+? WHERE name=?', (by, name))
+
+    def get(self, key):
+        with self.lock, self.db:
+            row = self.db.execute('UPDATE results SET used=? WHERE key=? RETURNING output',
+                                  (time.time(), key)).fetchone()
+            self._bump('hits' if row is not None else 'misses')
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key, output):
+        output = json.dumps(output)
+        size = len(key) + len(output)
+        with self.lock, self.db:
+            old = self.db.execute('SELECT size FROM results WHERE key=?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                            (key, output, size, time.time()))
+            self._bump('bytes', size - (old[0] if old else 0))
+            self._evict()
+
+    def _evict(self):
+        total = self.db.execute("SELECT value FROM stats WHERE name='bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Make some headroom so we don't evict on every put once full
+        target = total - self.max_bytes * 9 // 10
+        freed = 0
+        while freed < target:
+            oldest = self.db.execute('SELECT key, size FROM results ORDER BY used LIMIT 256').fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if freed >= target:
+                    break
+                self.db.execute('DELETE FROM results WHERE key=?', (key,))
+                freed += size
+        self._bump('bytes', -freed)
+
+    def stats(self):
+        with self.lock:
+            res = dict(self.db.execute('SELECT name, value FROM stats'))
+            res['entries'] = self.db.execute('SELECT count(*) FROM results').fetchone()[0]
+        return res
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,229 @@
+import sys, io, csv, json, math, struct, zlib
+
+from run import Case, Hypotheses, Hypothesis, ProfileBindings, Profile
+
+# Compact binary encoding of Case objects, for the database.
+#
+# An encoded case is a header, a string table and two flat arrays, walked in
+# the same fixed order by encode() and decode():
+#
+#   MAGIC, version (1 byte), then the sizes of the three parts (3 x u32)
+#   strings: UTF-8, NUL-separated
+#   ints (u32): string indices, counts, flags and profile indices
+#   floats (f64): rare, and each hypothesis' theta, drop-in and drop-outs
+#
+# Everything is little-endian. NONE stands for a missing string, NaN for a
+# missing drop-out. Replicates are stored sorted, so equal cases encode to
+# equal bytes.
+
+MAGIC = b'LRC'
+VERSION = 1
+NONE = 0xffffffff
+_SIZES = struct.Struct('<3I')
+_HEADER = len(MAGIC) + 1 + _SIZES.size
+
+def encode(case):
+    strings, index = [], {}
+    ints, floats = [], []
+
+    def string(val):
+        if val is None:
+            ints.append(NONE)
+            return
+        i = index.get(val)
+        if i is None:
+            if '\0' in val:
+                raise ValueError(f'NUL in {val!r}')
+            i = index[val] = len(strings)
+            strings.append(val)
+        ints.append(i)
+
+    def optional(val):
+        floats.append(math.nan if val is None else val)
+
+    profs = {id(prof): i for i, prof in enumerate(case.profiles.values())}
+
+    def bindings(pb):
+        ints.append(len(pb.map))
+        for prof, do in pb.map.items():
+            ints.append(profs[id(prof)])
+            optional(do)
+
+    floats.append(case.rare)
+    string(json.dumps(case.props))
+    ints.append(len(case.replicates))
+    for rep in sorted(case.replicates):
+        string(rep)
+    ints.append(len(case.profiles))
+    for prof in case.profiles.values():
+        string(prof.filename)
+        string(prof.sample_name)
+        ints.append(bool(prof.hz))
+    for hyp in case.hyp:
+        floats.extend((hyp.theta, hyp.drop_in, hyp.default_drop_out))
+        string(hyp.population)
+        ints.append(hyp.unknown_num)
+        optional(hyp.unknown_drop_out)
+        bindings(hyp.contributors)
+        bindings(hyp.non_contributors)
+
+    strtab = '\0'.join(strings).encode()
+    return b''.join((MAGIC, bytes((VERSION,)), _SIZES.pack(len(strtab), len(ints), len(floats)),
+                     strtab, struct.pack(f'<{len(ints)}I', *ints), struct.pack(f'<{len(floats)}d', *floats)))
+
+_props = {}  # props JSON -> decoded, for flat ones
+
+def _decode_props(text):
+    props = _props.get(text)
+    if props is None:
+        props = json.loads(text)
+        if any(isinstance(v, (dict, list)) for v in props.values()):
+            return props
+        if len(_props) >= 1024:
+            _props.clear()
+        _props[text] = props
+    return dict(props)
+
+def decode(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not an encoded case')
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError(f'unsupported case encoding version {data[len(MAGIC)]}')
+    nstr, nint, nfloat = _SIZES.unpack_from(data, len(MAGIC) + 1)
+    pos = _HEADER
+    strings = str(data[pos:pos + nstr], 'utf-8').split('\0')
+    strings.append(None)  # so that NONE, as an index, is None
+    pos += nstr
+    ints = struct.unpack_from(f'<{nint}I', data, pos)
+    floats = struct.unpack_from(f'<{nfloat}d', data, pos + 4 * nint)
+    # i and f walk ints and floats in the order encode() wrote them
+    none = len(strings) - 1
+    S = lambda i: strings[none if i == NONE else i]
+
+    case = Case.__new__(Case)
+    case.rare = floats[0]
+    case.props = _decode_props(strings[ints[0]])
+    n = ints[1]
+    case.replicates = {S(j) for j in ints[2:2 + n]}
+    i = 2 + n
+    plist = []
+    profiles = case.profiles = {}
+    for i in range(i + 1, i + 1 + 3 * ints[i], 3):
+        prof = Profile.__new__(Profile)
+        prof.filename, prof.sample_name, prof.hz = S(ints[i]), S(ints[i + 1]), bool(ints[i + 2])
+        profiles[prof.sample_name] = prof
+        plist.append(prof)
+    i = 2 + n + 1 + 3 * len(plist)
+    f = 1
+    case.hyp = hyps = Hypotheses.__new__(Hypotheses)
+    for name in ('p', 'd'):
+        hyp = Hypothesis.__new__(Hypothesis)
+        hyp.theta, hyp.drop_in, hyp.default_drop_out, udo = floats[f:f + 4]
+        hyp.unknown_drop_out = None if udo != udo else udo
+        hyp.population, hyp.unknown_num = S(ints[i]), ints[i + 1]
+        f += 4
+        i += 2
+        for attr in ('contributors', 'non_contributors'):
+            pb = ProfileBindings.__new__(ProfileBindings)
+            pb.map = bound = {}
+            for j in range(ints[i]):
+                do = floats[f + j]
+                bound[plist[ints[i + 1 + j]]] = None if do != do else do
+            f += ints[i]
+            i += 1 + ints[i]
+            setattr(hyp, attr, pb)
+        setattr(hyps, name, hyp)
+    return case
+
+# Outputs are stored as their CSV, deflated with a dictionary shared by the
+# whole database (made from its first outputs, see train_zdict):
+#
+#   OUTPUT_MAGIC, version (1 byte), dictionary id (u32, 0 for none)
+#   the deflated CSV, with a header of the first row's fields
+#
+# which saves repeating field names per row, as the JSON did, and most of
+# what's left is common to every output: locus names and the like.
+
+OUTPUT_MAGIC = b'LRO'
+OUTPUT_VERSION = 1
+_ZDICT_ID = struct.Struct('<I')
+_OUTPUT_HEADER = len(OUTPUT_MAGIC) + 1 + _ZDICT_ID.size
+ZDICT_SIZE = 1 << 15  # deflate can't look back any further
+
+def output_csv(rows):
+    if not rows:
+        return ''
+    sio = io.StringIO()
+    wr = csv.DictWriter(sio, list(rows[0]), lineterminator='\n')
+    wr.writeheader()
+    wr.writerows(rows)
+    return sio.getvalue()
+
+def train_zdict(outputs):
+    '''A dictionary for encode_output from some outputs: their CSVs, most
+    telling (the earliest) last, where deflate finds matches most cheaply.'''
+    data = b''
+    for rows in outputs:
+        text = output_csv(rows).encode()
+        if len(data) + len(text) > ZDICT_SIZE:
+            break
+        data = text + data
+    return data
+
+def encode_output(rows, zdict_id=0, zdict=None):
+    comp = zlib.compressobj(9, zdict=zdict) if zdict else zlib.compressobj(9)
+    data = comp.compress(output_csv(rows).encode()) + comp.flush()
+    return b''.join((OUTPUT_MAGIC, bytes((OUTPUT_VERSION,)), _ZDICT_ID.pack(zdict_id), data))
+
+def output_zdict_id(data):
+    return _ZDICT_ID.unpack_from(data, len(OUTPUT_MAGIC) + 1)[0]
+
+def relabel_output(data, zdict_ids):
+    '''An encoded output with its dictionary id mapped through `zdict_ids`,
+    for moving it to another database.'''
+    zid = output_zdict_id(data)
+    if not zid:
+        return data
+    return data[:len(OUTPUT_MAGIC) + 1] + _ZDICT_ID.pack(zdict_ids[zid]) + data[_OUTPUT_HEADER:]
+
+def decode_output(data, zdicts={}):
+    '''Rows from encode_output(), given {id: dictionary}, or from the JSON
+    text outputs were stored as before.'''
+    if isinstance(data, str):
+        return json.loads(data)
+    if data[:len(OUTPUT_MAGIC)] != OUTPUT_MAGIC:
+        raise ValueError('not an encoded output')
+    if data[len(OUTPUT_MAGIC)] != OUTPUT_VERSION:
+        raise ValueError(f'unsupported output encoding version {data[len(OUTPUT_MAGIC)]}')
+    zid = output_zdict_id(data)
+    decomp = zlib.decompressobj(zdict=zdicts[zid]) if zid else zlib.decompressobj()
+    text = decomp.decompress(data[_OUTPUT_HEADER:]) + decomp.flush()
+    return list(csv.DictReader(io.StringIO(text.decode())))
+
+if __name__ == '__main__':
+    # Microbenchmark: the binary encoding against the JSON one it replaces,
+    # on a prep_siblings-style case.
+    import timeit
+    from batch import JSONEncoder, JSONDecoder
+
+    case = Case()\
+        .with_population('/data/populations/Caucasian_FST_Frequencies.csv')\
+        .add_profiles(Profile('sib', sample_name='S123'))\
+        .add_evidence('/data/evidence/REP1.csv', '/data/evidence/REP2.csv')\
+        .typical_hypotheses('S123', 2)
+    for hyp in case.hyp:
+        hyp.theta, hyp.drop_in, hyp.default_drop_out = 0.03, 0.02, 0.05
+    case.props['case'] = '1'
+
+    je, jd = JSONEncoder(), JSONDecoder()
+    js, bs = je.encode(case), encode(case)
+    assert list(decode(bs).args()) == list(jd.decode(js).args()) == list(case.args())
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f'size: json {len(js.encode())} B, binary {len(bs)} B')
+    for what, jf, bf in (
+            ('encode', lambda: je.encode(case), lambda: encode(case)),
+            ('decode', lambda: jd.decode(js), lambda: decode(bs)),
+    ):
+        tj = min(timeit.repeat(jf, number=n, repeat=5)) / n
+        tb = min(timeit.repeat(bf, number=n, repeat=5)) / n
+        print(f'{what}: json {tj * 1e6:.2f} us, binary {tb * 1e6:.2f} us, {tj / tb:.1f}x')
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Stand-in for `java -jar LRmix.jar`, for exercising batch.py without a JVM.
+#
+# Use it as the "JVM": `batch.py db run -L anything.jar -J ./fake_lrmix.py`.
+# It drops the `-jar <path>` pair, parses the same arguments Case.args()
+# produces, and writes a plausible CSV to `-o`. Per-locus LRs are a
+# deterministic function of the locus, the tested genotypes, the contents of
+# the population and evidence files and the parameters, so repeated runs
+# agree with each other wherever the inputs happen to live.
+#
+# `--batch FILE -o OUT` runs every case in FILE (one JSON argument list per
+# line) and writes their CSVs to OUT, each followed by an empty line, reading
+# each input file only once.
+#
+# JVM options before `-jar` are accepted and ignored, except that class-data
+# sharing is mimicked: -XX:ArchiveClassesAtExit=F writes an "archive" to F,
+# and -XX:SharedArchiveFile=F cuts FAKE_LRMIX_STARTUP to a third if F exists.
+#
+# Environment knobs:
+#   FAKE_LRMIX_DELAY        seconds to sleep per case (scaled by unknowns)
+#   FAKE_LRMIX_STARTUP      seconds to sleep before anything else, like JVM start-up
+#   FAKE_LRMIX_CRASH_EVERY  in --serve mode, die without answering every N cases
+
+import sys, os, csv, json, time, hashlib
+
+FIELDS = ['Locus', 'Hp', 'Hd', 'LR', 'LRLog10']
+DEFAULT_LOCI = ['D3S1358', 'vWA', 'D16S539', 'CSF1PO', 'TPOX', 'D8S1179',
+                'D21S11', 'D18S51', 'D2S441', 'D19S433', 'TH01', 'FGA']
+
+# flag -> number of values it takes
+ARITY = {'-o': 1, '-R': 1, '-r': 1, '-p': 1, '--profile-no-hz': 1}
+for h in 'pd':
+    ARITY.update({f'-H{h}t': 1, f'-H{h}i': 1, f'-H{h}P': 1, f'-H{h}u': 2,
+                  f'-H{h}': 2, f'-H{h}nc': 2})
+
+def parse(argv):
+    opts = []
+    it = iter(argv)
+    for flag in it:
+        if flag not in ARITY:
+            raise SystemExit(f'fake_lrmix: unknown argument {flag!r}')
+        opts.append((flag, [next(it) for _ in range(ARITY[flag])]))
+    return opts
+
+def memoized(fn):
+    # Only within one --batch run, where a path can't change meaning
+    def wrapper(path, memo=None):
+        if memo is None:
+            return fn(path)
+        key = (fn.__name__, path)
+        if key not in memo:
+            memo[key] = fn(path)
+        return memo[key]
+    return wrapper
+
+@memoized
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+@memoized
+def read_markers(path):
+    markers = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            alleles = markers.setdefault(row['Marker'], set())
+            for k, v in row.items():
+                if k.startswith('Allele') and v:
+                    alleles.add(v)
+    return markers
+
+def compute(argv, memo=None):
+    opts = parse(argv)
+    out, reps, profs, params, unknowns = None, [], [], [], 0
+    for flag, vals in opts:
+        if flag == '-o':
+            out = vals[0]
+        elif flag == '-r':
+            reps.append(vals[0])
+        elif flag in ('-p', '--profile-no-hz'):
+            profs.append(vals[0])
+        elif flag.endswith('u'):
+            unknowns = max(unknowns, int(vals[0]))
+            params.append((flag, vals))
+        elif flag in ('-Hp', '-Hd', '-Hpnc', '-Hdnc'):
+            params.append((flag, vals[1:]))  # sample names don't matter
+        elif flag in ('-HpP', '-HdP'):
+            params.append((flag, [digest(vals[0], memo)]))
+        else:
+            params.append((flag, vals))
+    loci = {}
+    for rep in reps:
+        for marker in read_markers(rep, memo):
+            loci.setdefault(marker, [])
+    for prof in profs:
+        for marker, alleles in read_markers(prof, memo).items():
+            if marker in loci:
+                loci[marker].append(sorted(alleles))
+    if not loci:
+        loci = {locus: [] for locus in DEFAULT_LOCI}
+    delay = float(os.environ.get('FAKE_LRMIX_DELAY', 0))
+    if delay:
+        time.sleep(delay * (1 + unknowns))
+    base = json.dumps([sorted(digest(rep, memo) for rep in reps), sorted(params)], sort_keys=True)
+    rows, total = [], 0.0
+    for locus, gts in loci.items():
+        h = hashlib.sha1(json.dumps([base, locus, gts]).encode()).digest()
+        lr10 = int.from_bytes(h[:4], 'big') % 4000 / 1000.0 - 2.0
+        hd = 10.0 ** -(3 + h[4] % 5)
+        rows.append({'Locus': locus, 'Hp': repr(hd * 10 ** lr10), 'Hd': repr(hd),
+                     'LR': repr(10 ** lr10), 'LRLog10': repr(lr10)})
+        total += lr10
+    rows.append({'Locus': '_OVERALL_', 'Hp': '', 'Hd': '',
+                 'LR': repr(10 ** total), 'LRLog10': repr(total)})
+    return out, rows
+
+def write(f, rows):
+    wr = csv.DictWriter(f, FIELDS, lineterminator='\n')
+    wr.writeheader()
+    wr.writerows(rows)
+
+def serve(argv):
+    opts = dict(parse(argv))
+    crash_every = int(os.environ.get('FAKE_LRMIX_CRASH_EVERY', 0))
+    served = 0
+    with open(opts['-o'][0], 'w') as out:
+        for line in sys.stdin:
+            req = json.loads(line)
+            served += 1
+            if crash_every and served % crash_every == 0:
+                os._exit(3)
+            _, rows = compute(req['args'])
+            write(out, rows)
+            out.write('\n')
+            out.flush()
+
+def batch(argv):
+    opts = dict(parse(argv[1:]))
+    memo = {}
+    with open(argv[0]) as cases, open(opts['-o'][0], 'w') as out:
+        for line in cases:
+            _, rows = compute(json.loads(line), memo)
+            write(out, rows)
+            out.write('\n')
+
+def start_jvm(opts):
+    opts = dict(opt.partition('=')[::2] for opt in opts)
+    startup = float(os.environ.get('FAKE_LRMIX_STARTUP', 0))
+    archive = opts.get('-XX:SharedArchiveFile')
+    if archive is not None and os.path.exists(archive):
+        startup /= 3
+    time.sleep(startup)
+    dump = opts.get('-XX:ArchiveClassesAtExit')
+    if dump is not None:
+        with open(dump, 'w') as f:
+            f.write('fake class-data archive\n')
+
+def main(argv):
+    jvm = []
+    while argv and argv[0].startswith(('-X', '-D')):
+        jvm.append(argv.pop(0))
+    start_jvm(jvm)
+    if argv[:1] == ['-jar']:
+        argv = argv[2:]
+    if argv[:1] == ['--serve']:
+        return serve(argv[1:])
+    if argv[:1] == ['--batch']:
+        return batch(argv[1:])
+    out, rows = compute(argv)
+    with open(out, 'w') if out is not None else os.fdopen(1, 'w', closefd=False) as f:
+        write(f, rows)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,244 @@
+import csv, os, math, itertools
+from collections import OrderedDict
+
+import numpy as np
+
+from tracing import span
+from run import OVERALL, project_output
+
+# Semi-continuous (drop-out/drop-in) likelihood model as used by LRmix:
+#
+# Pr(E|H) = sum over the genotypes G of the unknowns of
+#     Pr(G | known profiles, theta) * prod over replicates Pr(R | contributors)
+#
+# An allele carried by the contributors drops out of a replicate with the
+# product of d_i over every copy carried by contributor i (so d^2 for a
+# homozygote). Observed alleles nobody carries are drop-ins, each with
+# probability c * p_a; a replicate without drop-in contributes (1 - c).
+# Unknown genotypes are weighted with the Balding-Nichols sampling formula,
+# conditioned on the alleles of every typed person named in the hypothesis.
+# Alleles that are neither in the evidence nor in a known profile are lumped
+# into a single Q allele. Alleles missing from the frequency table get the
+# case's rare allele frequency, or the locus minimum if that is zero.
+
+def norm_allele(a):
+    a = a.strip()
+    try:
+        fa = float(a)
+    except ValueError:
+        return a
+    if fa == int(fa):
+        return str(int(fa))
+    return str(fa)
+
+def read_population(path):
+    freqs = {}  # locus -> allele -> frequency
+    with open(path) as f:
+        rd = csv.reader(f)
+        hdr = next(rd)
+        for row in rd:
+            if not row or not row[0].strip():
+                continue
+            allele = norm_allele(row[0])
+            for locus, val in zip(hdr[1:], row[1:]):
+                val = val.strip()
+                if val:
+                    freqs.setdefault(locus.strip(), {})[allele] = float(val)
+    return freqs
+
+def read_samples(path):
+    samples = OrderedDict()  # sample -> locus -> set of alleles
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            loci = samples.setdefault(row['SampleName'], OrderedDict())
+            alleles = loci.setdefault(row['Marker'].strip(), set())
+            for k, v in row.items():
+                if k.startswith('Allele') and v and v.strip():
+                    alleles.add(norm_allele(v))
+    return samples
+
+def read_genotypes(path, sample_name):
+    samples = read_samples(path)
+    loci = samples.get(sample_name)
+    if loci is None:
+        # Profiles generated by row_to_contents carry only one sample
+        loci = next(iter(samples.values()), {})
+    gts = {}
+    for locus, alleles in loci.items():
+        alleles = sorted(alleles)
+        if len(alleles) == 1:
+            alleles = alleles * 2
+        if len(alleles) != 2:
+            raise ValueError(f'{path}: {sample_name} has {len(alleles)} alleles at {locus}')
+        gts[locus] = tuple(alleles)
+    return gts
+
+_combos = {}
+
+def unknown_combos(n, unknowns):
+    '''Unordered genotype combinations for `unknowns` people over `n` alleles.
+
+    Returns (seq, mult): the 2U allele indices of each combination, and the
+    number of ordered genotype assignments it stands for (heterozygote
+    orderings included). The sampling formula is exchangeable, so summing
+    over multisets with these weights is exact.'''
+    key = (n, unknowns)
+    if key not in _combos:
+        gts = [(a, b) for a in range(n) for b in range(a, n)]
+        combos = list(itertools.combinations_with_replacement(range(len(gts)), unknowns))
+        seq = np.array([[x for g in c for x in gts[g]] for c in combos], dtype=np.intp)
+        seq = seq.reshape(len(combos), 2 * unknowns)
+        mult = np.empty(len(combos))
+        for i, c in enumerate(combos):
+            m = math.factorial(unknowns)
+            for g, run in itertools.groupby(c):
+                m //= math.factorial(len(list(run)))
+            mult[i] = m * 2 ** sum(gts[g][0] != gts[g][1] for g in c)
+        _combos[key] = (seq, mult)
+    return _combos[key]
+
+class NativeInterface:
+    '''In-process replacement for Interface, computing the likelihoods with
+    NumPy instead of shelling out to the JAR.
+
+    Evaluates every locus of a hypothesis at once (loci are padded to a
+    common allele count with zero-frequency alleles) and walks the unknown
+    genotype combinations in chunks of at most `budget` array elements.
+    Outputs are cut down to `store` (see run.read_output).'''
+    def __init__(self, budget=1 << 22, store='full'):
+        self.budget = budget
+        self.store = store
+        self.files = {}  # path -> (stamp, parsed)
+
+    def _cached(self, path, parse):
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        ent = self.files.get(path)
+        if ent is None or ent[0] != stamp:
+            ent = self.files[path] = (stamp, parse(path))
+        return ent[1]
+
+    def evidence(self, case):
+        reps = []
+        for path in sorted(case.replicates):
+            reps.extend(self._cached(path, read_samples).values())
+        return reps
+
+    def loci(self, freqs, reps, gts):
+        loci = []
+        for rep in reps:
+            for locus in rep:
+                if locus not in loci and locus in freqs and all(locus in g for g in gts.values()):
+                    loci.append(locus)
+        return loci
+
+    def locus_alleles(self, case, locus, freqs, reps, gts):
+        alleles = set()
+        for rep in reps:
+            alleles.update(rep.get(locus, ()))
+        for g in gts.values():
+            alleles.update(g[locus])
+        alleles = sorted(alleles)
+        table = freqs[locus]
+        rare = case.rare if case.rare > 0 else min(table.values())
+        p = [table.get(a, rare) for a in alleles]
+        return alleles, p
+
+    def likelihood(self, hyp, loci, alleles, reps, gts):
+        L = len(loci)
+        n = max(len(names) for names, _ in alleles) + 1  # + Q
+        p = np.zeros((L, n))
+        known = np.zeros((L, n))   # allele counts of typed people
+        kdrop = np.ones((L, n))    # drop-out product of known contributors
+        kpres = np.zeros((L, n), dtype=bool)
+        obs = np.zeros((len(reps), L, n), dtype=bool)
+        for l, locus in enumerate(loci):
+            names, freq = alleles[l]
+            p[l, :len(names)] = freq
+            p[l, -1] = max(0.0, 1.0 - sum(freq))
+            idx = {a: i for i, a in enumerate(names)}
+            for prof, do in hyp.each_contributor_drop_out():
+                for a in gts[prof.sample_name][locus]:
+                    known[l, idx[a]] += 1
+                    kdrop[l, idx[a]] *= do
+                    kpres[l, idx[a]] = True
+            for prof, _ in hyp.each_non_contributor_drop_out():
+                for a in gts[prof.sample_name][locus]:
+                    known[l, idx[a]] += 1
+            for r, rep in enumerate(reps):
+                for a in rep.get(locus, ()):
+                    obs[r, l, idx[a]] = True
+        m0 = known.sum(axis=1)
+        theta, c, du = hyp.theta, hyp.drop_in, hyp.get_unknown_drop_out()
+        U = hyp.unknown_num
+
+        seq, mult = unknown_combos(n, U)
+        # How many earlier draws in the sequence hit the same allele
+        same = np.zeros(seq.shape)
+        for j in range(1, 2 * U):
+            same[:, j] = (seq[:, :j] == seq[:, j:j + 1]).sum(axis=1)
+        denom = 1.0 + (m0[:, None] + np.arange(2 * U)[None, :] - 1.0) * theta  # (L, 2U)
+
+        total = np.zeros(L)
+        chunk = max(1, self.budget // (L * n * max(1, len(reps))))
+        for lo in range(0, len(mult), chunk):
+            s, w = seq[lo:lo + chunk], mult[lo:lo + chunk]
+            C = len(w)
+            # Pr(G_u | known): sequential sampling formula, (L, C)
+            x = known[:, s] + same[lo:lo + chunk][None]
+            pg = ((x * theta + (1.0 - theta) * p[:, s]) / denom[:, None, :]).prod(axis=2) * w[None]
+            # Unknown allele copies per combination, (C, n)
+            ucopies = np.zeros((C, n))
+            for j in range(2 * U):
+                np.add.at(ucopies, (np.arange(C), s[:, j]), 1)
+            drop = kdrop[:, None, :] * du ** ucopies[None]  # (L, C, n)
+            pres = kpres[:, None, :] | (ucopies > 0)[None]
+            pe = pg
+            for r in range(len(reps)):
+                o = obs[r][:, None, :]
+                dropin = ~pres & o
+                f = np.where(pres, np.where(o, 1.0 - drop, drop), 1.0)
+                f = np.where(dropin, c * p[:, None, :], f)
+                pe = pe * f.prod(axis=2) * np.where(dropin.any(axis=2), 1.0, 1.0 - c)
+            total += pe.sum(axis=1)
+        return total
+
+    def compute(self, case, resolve=None):
+        # Shared inputs are parsed once from their real paths; only the
+        # profiles need resolving to wherever they were staged.
+        resolve = resolve or (lambda p: p)
+        pops = {h.population for h in case.hyp}
+        freqs = {pop: self._cached(pop, read_population) for pop in pops}
+        reps = self.evidence(case)
+        gts = {name: read_genotypes(resolve(prof.filename), name) for name, prof in case.profiles.items()}
+        common = {}
+        for f in freqs.values():
+            common = f if not common else {k: v for k, v in common.items() if k in f}
+        loci = self.loci(common, reps, gts)
+        if not loci:
+            return [{'Locus': OVERALL, 'Hp': '', 'Hd': '', 'LR': 'nan', 'LRLog10': 'nan'}]
+        lik = {}
+        for name, hyp in (('Hp', case.hyp.p), ('Hd', case.hyp.d)):
+            f = freqs[hyp.population]
+            alleles = [self.locus_alleles(case, locus, f, reps, gts) for locus in loci]
+            lik[name] = self.likelihood(hyp, loci, alleles, reps, gts)
+        rows = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lr = lik['Hp'] / lik['Hd']
+            lr10 = np.log10(lr)
+        for l, locus in enumerate(loci):
+            rows.append({'Locus': locus, 'Hp': repr(float(lik['Hp'][l])), 'Hd': repr(float(lik['Hd'][l])),
+                         'LR': repr(float(lr[l])), 'LRLog10': repr(float(lr10[l]))})
+        rows.append({'Locus': OVERALL, 'Hp': repr(float(lik['Hp'].prod())), 'Hd': repr(float(lik['Hd'].prod())),
+                     'LR': repr(float(lr.prod())), 'LRLog10': repr(float(lr10.sum()))})
+        return rows
+
+    def run_many(self, items):
+        return [self.run(case, resolve) for case, resolve in items]
+
+    def run(self, case, resolve=None):
+        with span('native'):
+            return project_output(self.compute(case, resolve), self.store)
+
+    def close(self):
+        pass
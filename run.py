@@ -1,17 +1,20 @@
-import csv, subprocess, os
+import csv, subprocess, os, json, sys, math, contextlib, asyncio, io, itertools, time, hashlib, shutil
+
+from tracing import span, async_span
 
 DEVFD = '/dev/fd'
 
-# XXX eventually get rid of these constructor-bypassing shenanigans
-class Dummy: pass
+def _same(x):
+    return x
 
 def make_from_json(cls, jo):
-    inst = Dummy()
-    inst.__class__ = cls
+    inst = cls.__new__(cls)
     inst.from_json(jo)
     return inst
 
 class ProfileBindings:
+    __slots__ = ('map',)
+
     def __init__(self):
         self.map = {}  # profile -> drop out (possibly None)
 
@@ -32,6 +35,9 @@ class ProfileBindings:
         }
 
 class Hypothesis:
+    __slots__ = ('theta', 'drop_in', 'default_drop_out', 'population', 'unknown_num',
+                 'unknown_drop_out', 'contributors', 'non_contributors')
+
     def __init__(self):
         # Values initialized to LRMix defaults
         self.theta = 0.01
@@ -49,6 +55,7 @@ class Hypothesis:
             return self
         locals()[f'set_{attr}'] = setter
         del setter
+    del attr
 
     def map_drop_out(self, do):
         if do is None:
@@ -66,15 +73,15 @@ class Hypothesis:
         for ncont, do in self.non_contributors.map.items():
             yield (ncont, self.map_drop_out(do))
 
-    def args(self, infix):
+    def args(self, infix, resolve=_same, alias=_same):
         yield from [f'-H{infix}t', str(self.theta)]
         yield from [f'-H{infix}i', str(self.drop_in)]
-        yield from [f'-H{infix}P', self.population]
+        yield from [f'-H{infix}P', resolve(self.population)]
         yield from [f'-H{infix}u', str(self.unknown_num), str(self.get_unknown_drop_out())]
         for prof, do in self.each_contributor_drop_out():
-            yield from [f'-H{infix}', prof.sample_name, str(do)]
+            yield from [f'-H{infix}', alias(prof.sample_name), str(do)]
         for prof, do in self.each_non_contributor_drop_out():
-            yield from [f'-H{infix}nc', prof.sample_name, str(do)]
+            yield from [f'-H{infix}nc', alias(prof.sample_name), str(do)]
 
     def to_json(self):
         return {
@@ -103,6 +110,8 @@ class Hypothesis:
         self.non_contributors.fix_samples(mapping)
 
 class Hypotheses:
+    __slots__ = ('p', 'd')
+
     def __init__(self):
         self.p = Hypothesis()
         self.d = Hypothesis()
@@ -110,9 +119,9 @@ class Hypotheses:
     def __iter__(self):
         return iter((self.p, self.d))
 
-    def args(self):
-        yield from self.p.args('p')
-        yield from self.d.args('d')
+    def args(self, resolve=_same, alias=_same):
+        yield from self.p.args('p', resolve, alias)
+        yield from self.d.args('d', resolve, alias)
 
     def to_json(self):
         return {
@@ -129,6 +138,8 @@ class Hypotheses:
         self.d.fix_samples(mapping)
 
 class Profile:
+    __slots__ = ('filename', 'hz', 'sample_name')
+
     def __init__(self, filename, hz = True, sample_name = None):
         self.filename = filename
         self.hz = hz
@@ -141,8 +152,8 @@ class Profile:
                 rd = csv.DictReader(fd)
                 self.sample_name = next(rd)["SampleName"]
 
-    def args(self):
-        yield from ['-p' if self.hz else '--profile-no-hz', self.filename]
+    def args(self, resolve=_same):
+        yield from ['-p' if self.hz else '--profile-no-hz', resolve(self.filename)]
 
     def to_json(self):
         return {
@@ -158,6 +169,8 @@ class Profile:
         self._set_sample_name()
 
 class Case:
+    __slots__ = ('replicates', 'profiles', 'hyp', 'rare', 'props')
+
     def __init__(self):
         self.replicates = set()  # of evidence paths
         self.profiles = {} # sample name -> Profile
@@ -170,6 +183,15 @@ class Case:
             self.profiles[prof.sample_name] = prof
         return self
 
+    def rename_profile(self, old, new):
+        '''Rename a profile; hypotheses refer to the Profile object, so they
+        follow along.'''
+        self.profiles[old].sample_name = new
+        self.profiles = {
+            (new if name == old else name): prof for name, prof in self.profiles.items()
+        }
+        return self
+
     def add_evidence(self, *reps):
         self.replicates.update(reps)
         return self
@@ -189,13 +211,15 @@ class Case:
         self.hyp.p.contributors.add(prof, pdo)
         return self
 
-    def args(self):
+    def args(self, resolve=_same, alias=_same):
+        '''LRmix arguments for this case. `resolve` maps every file path and
+        `alias` every sample name, for callers that need to rewrite them.'''
         yield from ['-R', str(self.rare)]
-        for rep in self.replicates:
-            yield from ['-r', rep]
+        for rep in sorted(self.replicates):
+            yield from ['-r', resolve(rep)]
         for prof in self.profiles.values():
-            yield from prof.args()
-        yield from self.hyp.args()
+            yield from prof.args(resolve)
+        yield from self.hyp.args(resolve, alias)
 
     def to_json(self):
         return {
@@ -217,23 +241,468 @@ class Case:
         self.hyp = make_from_json(Hypotheses, jo['hyp'])
         self.hyp.fix_samples(self.profiles)
 
+class Sweep:
+    '''A grid of case parameters, whose cases are built lazily.
+
+    Each axis is a list of values; population and contributors must be
+    given, the others keep the Hypothesis/Case defaults if they aren't.
+    Points come out of points() as dicts, in itertools.product order.'''
+    AXES = ('population', 'contributors', 'theta', 'drop_in', 'drop_out', 'rare')
+
+    def __init__(self, replicates, **axes):
+        unknown = set(axes) - set(self.AXES)
+        if unknown:
+            raise TypeError(f'unknown sweep axes: {", ".join(sorted(unknown))}')
+        for name in ('population', 'contributors'):
+            if not axes.get(name):
+                raise TypeError(f'sweep needs at least one {name}')
+        self.replicates = list(replicates)
+        self.axes = {name: list(axes[name]) for name in self.AXES if name in axes}
+
+    def __len__(self):
+        return math.prod(map(len, self.axes.values()))
+
+    def points(self):
+        for vals in itertools.product(*self.axes.values()):
+            yield dict(zip(self.axes, vals))
+
+    def case(self, point, profile):
+        '''The case at `point` testing `profile`.'''
+        case = Case()\
+            .with_population(point['population'])\
+            .add_profiles(profile)\
+            .add_evidence(*self.replicates)\
+            .typical_hypotheses(profile.sample_name, point['contributors'])
+        for hyp in case.hyp:
+            for axis, attr in (('theta', 'theta'), ('drop_in', 'drop_in'), ('drop_out', 'default_drop_out')):
+                if axis in point:
+                    setattr(hyp, attr, point[axis])
+        if 'rare' in point:
+            case.rare = point['rare']
+        return case
+
+    def cases(self, profile):
+        for point in self.points():
+            yield self.case(point, profile)
+
+class Staging:
+    '''Keeps input files in memory (memfds) and hands out /proc/<pid>/fd paths
+    to them, which work for us and for any child process alike.
+
+    Shared inputs (populations, replicates) are copied in once and kept until
+    they change on disk; per-case files only live for the `files` context.'''
+    def __init__(self):
+        self.shared = {}  # path -> ((mtime, size), fd)
+
+    def _fd(self, name, data):
+        fd = os.memfd_create(name)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        return fd
+
+    def path(self, fd):
+        return f'/proc/{os.getpid()}/fd/{fd}'
+
+    def share(self, path):
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        ent = self.shared.get(path)
+        if ent is None or ent[0] != stamp:
+            if ent is not None:
+                os.close(ent[1])
+            with open(path, 'rb') as f:
+                ent = self.shared[path] = (stamp, self._fd(os.path.basename(path), f.read()))
+        return self.path(ent[1])
+
+    @contextlib.contextmanager
+    def files(self, files):
+        '''Stage `files` (name -> contents) and yield a resolver for
+        Case.args() that maps those names, and any other path, to staged
+        copies.'''
+        fds = {}
+        try:
+            for name, data in files.items():
+                fds[name] = self._fd(name, data.encode())
+            paths = {name: self.path(fd) for name, fd in fds.items()}
+            yield lambda p: paths[p] if p in paths else self.share(p)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+    def close(self):
+        for _, fd in self.shared.values():
+            os.close(fd)
+        self.shared = {}
+
+# JVM options for launching LRmix, by name. Every case is a short-lived JVM
+# unless it's persistent: `short` trades peak performance for start-up (C1
+# only, serial GC, no perf counters), `long` is for persistent workers.
+LAUNCH_PROFILES = {
+    'plain': (),
+    'short': ('-XX:TieredStopAtLevel=1', '-XX:+UseSerialGC', '-XX:-UsePerfData', '-XX:CICompilerCount=1'),
+    'long': ('-XX:+UseParallelGC', '-XX:-UsePerfData'),
+}
+
+def launch_args(profile='plain', heap=None, extra=()):
+    '''JVM options from a LAUNCH_PROFILES name, a maximum heap size (as for
+    -Xmx) and any others.'''
+    args = list(LAUNCH_PROFILES[profile])
+    if heap is not None:
+        args.append(f'-Xmx{heap}')
+    return args + list(extra)
+
+def cds_archive(directory, lrmix, java='java'):
+    '''Where to keep the class-data sharing archive for this JAR and JVM in
+    `directory`; named after both, so replacing either starts afresh.'''
+    java = os.path.realpath(shutil.which(java) or java)
+    key = [os.path.abspath(lrmix)]
+    for path in (lrmix, java):
+        st = os.stat(path)
+        key.extend((st.st_size, st.st_mtime_ns))
+    return os.path.join(directory, f'lrmix-{hashlib.sha1(json.dumps([java] + key).encode()).hexdigest()[:12]}.jsa')
+
+# How much of LRmix's output to keep: every column of every row, the LRs of
+# every locus, or only the _OVERALL_ LRs
+STORES = ('full', 'loci', 'overall')
+OVERALL = '_OVERALL_'
+LR_FIELDS = ('Locus', 'LR', 'LRLog10')
+
+def read_output(lines, store='full'):
+    '''LRmix's CSV output as a list of dicts, keeping what `store` says.
+    Rows are parsed one at a time, and only the kept columns make it into
+    the dicts.'''
+    if store == 'full':
+        return list(csv.DictReader(lines))
+    rd = csv.reader(lines)
+    hdr = next(rd, [])
+    cols = [(i, name) for i, name in enumerate(hdr) if name in LR_FIELDS]
+    locus = hdr.index('Locus') if 'Locus' in hdr else None
+    out = []
+    for rec in rd:
+        if not rec or store == 'overall' and rec[locus] != OVERALL:
+            continue
+        out.append({name: rec[i] if i < len(rec) else None for i, name in cols})
+    return out
+
+def project_output(rows, store='full'):
+    '''read_output(), for an output that's already been read.'''
+    if store == 'full':
+        return rows
+    return [{name: row[name] for name in LR_FIELDS if name in row} for row in rows
+            if store == 'loci' or row.get('Locus') == OVERALL]
+
 class Interface:
-    def __init__(self, lrmix, java='java'):
+    batch_args = ('--batch',)
+    # A lock on dumping the CDS archive older than this was left by a crash
+    CDS_LOCK_STALE = 600
+
+    def __init__(self, lrmix, java='java', jvm_args=(), cds=None, store='full'):
         self.lrmix = lrmix
         self.java = java
+        self.jvm_args = list(jvm_args)
+        self.cds = cds  # class-data sharing archive, see launcher()
+        self.store = store  # what to keep of outputs, see read_output()
+
+    def command(self):
+        '''The command line up to LRmix's own arguments, using the CDS
+        archive if there is one.'''
+        args = [self.java] + self.jvm_args
+        if self.cds is not None and os.path.exists(self.cds):
+            args.extend(('-Xshare:auto', f'-XX:SharedArchiveFile={self.cds}'))
+        return args + ['-jar', self.lrmix]
+
+    def take_cds_lock(self):
+        lock = f'{self.cds}.lock'
+        for _ in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return lock
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(lock).st_mtime < self.CDS_LOCK_STALE:
+                        return None
+                    os.unlink(lock)
+                except FileNotFoundError:
+                    pass
+        return None
+
+    @contextlib.contextmanager
+    def launcher(self):
+        '''command(), for a launch that lasts as long as the with block. If
+        there's meant to be a CDS archive but there isn't one yet, the first
+        launch to get here (in any process) dumps one when its JVM exits,
+        for all later ones to use.'''
+        if self.cds is None or os.path.exists(self.cds):
+            yield self.command()
+            return
+        lock = self.take_cds_lock()
+        if lock is None:
+            yield self.command()
+            return
+        tmp = f'{self.cds}.{os.getpid()}.tmp'
+        try:
+            yield [self.java] + self.jvm_args + [f'-XX:ArchiveClassesAtExit={tmp}', '-jar', self.lrmix]
+            if os.path.exists(tmp):
+                os.replace(tmp, self.cds)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            os.unlink(lock)
 
-    def run(self, case):
+    def launch_latency(self, case, resolve=_same):
+        '''Seconds from spawning LRmix for `case` until its first output.'''
+        rdfd, wrfd = os.pipe()
+        with self.launcher() as cmd, os.fdopen(rdfd, 'rb') as rd:
+            args = cmd + ['-o', os.path.join(DEVFD, str(wrfd))] + list(case.args(resolve))
+            start = time.perf_counter()
+            proc = subprocess.Popen(args, pass_fds=(0, 1, 2, wrfd))
+            with proc:
+                os.close(wrfd)
+                rd.read(1)
+                latency = time.perf_counter() - start
+                rd.read()
+        return latency
+
+    def run(self, case, resolve=_same):
         rdfd, wrfd = os.pipe()
         rd = os.fdopen(rdfd, 'r')
-        args = [self.java, '-jar', self.lrmix, '-o', os.path.join(DEVFD, str(wrfd))]
-        args.extend(case.args())
-        with subprocess.Popen(args, pass_fds=(0, 1, 2, wrfd)) as proc:
-            os.close(wrfd)
+        with self.launcher() as cmd:
+            args = cmd + ['-o', os.path.join(DEVFD, str(wrfd))]
+            args.extend(case.args(resolve))
+            with span('spawn'):
+                proc = subprocess.Popen(args, pass_fds=(0, 1, 2, wrfd))
+            with proc:
+                os.close(wrfd)
+                with span('lrmix'):
+                    proc.wait()
         try:
-            return list(csv.DictReader(rd))
+            with span('parse'):
+                return read_output(rd, self.store)
         finally:
             rd.close()
 
+    def run_many(self, items):
+        '''Outputs for several (case, resolve) pairs from one LRmix
+        invocation, so shared inputs are only parsed once.
+
+        The cases go one JSON argument list per line into a file passed after
+        `batch_args`, and LRmix answers each with its CSV followed by an
+        empty line, in order, as for PersistentInterface.'''
+        if len(items) == 1:
+            return [self.run(*items[0])]
+        cases = os.memfd_create('cases')
+        rdfd, wrfd = os.pipe()
+        rd = os.fdopen(rdfd, 'r')
+        try:
+            with os.fdopen(os.dup(cases), 'w') as f:
+                for case, resolve in items:
+                    f.write(json.dumps(list(case.args(resolve))) + '\n')
+            with self.launcher() as cmd:
+                args = cmd + list(self.batch_args)
+                args.extend([os.path.join(DEVFD, str(cases)), '-o', os.path.join(DEVFD, str(wrfd))])
+                with span('spawn', cases=len(items)):
+                    proc = subprocess.Popen(args, pass_fds=(0, 1, 2, cases, wrfd))
+                with proc:
+                    os.close(wrfd)
+                    wrfd = None
+                    with span('lrmix', cases=len(items)):
+                        blocks, lines = [], []
+                        for line in rd:
+                            if line == '\n':
+                                blocks.append(lines)
+                                lines = []
+                            else:
+                                lines.append(line)
+            with span('parse', cases=len(items)):
+                outs = [read_output(lines, self.store) for lines in blocks]
+            if len(outs) != len(items):
+                raise WorkerDied(f'LRmix answered {len(outs)} of {len(items)} cases (exit status {proc.returncode})')
+            return outs
+        finally:
+            rd.close()
+            os.close(cases)
+            if wrfd is not None:
+                os.close(wrfd)
+
+    def close(self):
+        pass
+
+class AsyncInterface(Interface):
+    '''Interface for asyncio callers: LRmix is started with
+    create_subprocess_exec and its output pipe is read without blocking the
+    event loop. A case still running after `timeout` seconds is killed and
+    raises asyncio.TimeoutError.'''
+    def __init__(self, lrmix, java='java', timeout=None, jvm_args=(), cds=None, store='full'):
+        super().__init__(lrmix, java, jvm_args, cds, store)
+        self.timeout = timeout
+
+    async def run_async(self, case, resolve=_same):
+        with self.launcher() as cmd:
+            return await self.launch_async(cmd, case, resolve)
+
+    async def launch_async(self, cmd, case, resolve):
+        loop = asyncio.get_running_loop()
+        rdfd, wrfd = os.pipe()
+        rd = os.fdopen(rdfd, 'rb')
+        args = cmd + ['-o', os.path.join(DEVFD, str(wrfd))]
+        args.extend(case.args(resolve))
+        try:
+            with span('spawn'):
+                proc = await asyncio.create_subprocess_exec(*args, pass_fds=(wrfd,))
+        except BaseException:
+            rd.close()
+            raise
+        finally:
+            os.close(wrfd)
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), rd)
+        async def collect():
+            data = await reader.read()
+            await proc.wait()
+            return data
+        try:
+            with async_span('lrmix'):
+                data = await asyncio.wait_for(collect(), self.timeout)
+        finally:
+            transport.close()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        with span('parse'):
+            return read_output(io.StringIO(data.decode()), self.store)
+
+class WorkerDied(Exception):
+    pass
+
+class PersistentInterface(Interface):
+    '''Keeps one long-lived LRmix process around instead of one per case.
+
+    The worker is started with `serve_args` and an `-o` pointing at a pipe.
+    Each case is sent on its stdin as one line of JSON, `{"args": [...]}`
+    (every path in them absolute, see Staging), and the worker answers on the
+    pipe with the CSV for that case followed by an empty line. The worker is restarted if it dies, and
+    recycled after `max_cases` cases if that is set.'''
+    def __init__(self, lrmix, java='java', serve_args=('--serve',), max_cases=None, retries=1, jvm_args=(), cds=None,
+                 store='full'):
+        super().__init__(lrmix, java, jvm_args, cds, store)
+        self.serve_args = list(serve_args)
+        self.max_cases = max_cases
+        self.retries = retries
+        self.proc = None
+        self.rd = None
+        self.served = 0
+
+    def start(self):
+        rdfd, wrfd = os.pipe()
+        self.rd = os.fdopen(rdfd, 'r')
+        # Only uses an archive: the worker's JVM may live for the whole run
+        args = self.command() + self.serve_args
+        args.extend(['-o', os.path.join(DEVFD, str(wrfd))])
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, text=True,
+                                     pass_fds=(0, 1, 2, wrfd))
+        os.close(wrfd)
+        self.served = 0
+
+    def close(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        self.rd.close()
+        self.rd = None
+
+    def request(self, case, resolve):
+        if self.proc is None or self.proc.poll() is not None:
+            self.close()
+            self.start()
+        with span('lrmix'):
+            self.proc.stdin.write(json.dumps({'args': list(case.args(resolve))}) + '\n')
+            self.proc.stdin.flush()
+            lines = []
+            for line in self.rd:
+                if line == '\n':
+                    break
+                lines.append(line)
+            else:
+                raise WorkerDied(f'LRmix worker exited with {self.proc.wait()}')
+        self.served += 1
+        if self.max_cases is not None and self.served >= self.max_cases:
+            self.close()
+        with span('parse'):
+            return read_output(lines, self.store)
+
+    def run_many(self, items):
+        # The worker already parses shared inputs only once
+        return [self.run(case, resolve) for case, resolve in items]
+
+    def run(self, case, resolve=_same):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.request(case, resolve)
+            except (OSError, WorkerDied):
+                self.close()
+                if attempt >= self.retries:
+                    raise
+
+class Mismatch(Exception):
+    pass
+
+def compare_outputs(out, ref, rel_tol=1e-6):
+    '''Loci whose LR differs between two outputs, as (locus, LR, reference LR).'''
+    lrs = {row['Locus']: float(row['LR']) for row in out}
+    bad = []
+    for row in ref:
+        lr, rlr = lrs.pop(row['Locus'], None), float(row['LR'])
+        if lr is None or not (math.isclose(lr, rlr, rel_tol=rel_tol) or (math.isnan(lr) and math.isnan(rlr))):
+            bad.append((row['Locus'], lr, rlr))
+    bad.extend((locus, lr, None) for locus, lr in lrs.items())
+    return bad
+
+class CrossCheckInterface:
+    '''Runs each case through a candidate and a reference interface and
+    compares their LRs locus by locus.
+
+    The reference output is what gets returned. Disagreements beyond
+    `rel_tol` are reported on stderr, or raised as Mismatch if `strict`.'''
+    def __init__(self, candidate, reference, rel_tol=1e-6, strict=False):
+        self.candidate = candidate
+        self.reference = reference
+        self.rel_tol = rel_tol
+        self.strict = strict
+
+    def check(self, case, out, ref):
+        bad = compare_outputs(out, ref, self.rel_tol)
+        if bad:
+            msg = f'LR mismatch for {" ".join(case.args())}: ' + ', '.join(
+                f'{locus} {lr} != {rlr}' for locus, lr, rlr in bad
+            )
+            if self.strict:
+                raise Mismatch(msg)
+            print(msg, file=sys.stderr)
+        return ref
+
+    def run(self, case, resolve=_same):
+        ref = self.reference.run(case, resolve)
+        return self.check(case, self.candidate.run(case, resolve), ref)
+
+    def run_many(self, items):
+        refs = self.reference.run_many(items)
+        outs = self.candidate.run_many(items)
+        return [self.check(case, out, ref) for (case, _), out, ref in zip(items, outs, refs)]
+
+    def close(self):
+        self.candidate.close()
+        self.reference.close()
+
 if __name__ == '__main__':
     case = Case()\
         .with_population('/home/grissess/School/FST/fst_populations/Asian_FST_Frequencies.csv')\
@@ -0,0 +1,111 @@
+import os, json, time, threading, itertools, contextlib, glob
+
+# Opt-in phase tracing, written as Chrome trace JSON (load it in
+# chrome://tracing or ui.perfetto.dev).
+#
+# Nothing is recorded until start(); until then span() hands out a shared
+# no-op context manager, so the hooks cost one global lookup. Timestamps are
+# wall-clock microseconds, so traces from several processes line up when
+# merged.
+
+_events = None  # list of trace events while tracing
+_threads = set()  # (pid, tid) we've named
+_ids = itertools.count()
+_NULL = contextlib.nullcontext()
+
+def start():
+    global _events
+    _events = []
+    _threads.clear()
+
+def stop():
+    '''Stop tracing; returns the events recorded.'''
+    global _events
+    events, _events = _events, None
+    return events or []
+
+def enabled():
+    return _events is not None
+
+def _name_thread(events, pid, tid):
+    if (pid, tid) not in _threads:
+        _threads.add((pid, tid))
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                       'args': {'name': threading.current_thread().name}})
+
+class _Span:
+    __slots__ = ('events', 'name', 'args', 'start')
+
+    def __init__(self, events, name, args):
+        self.events, self.name, self.args = events, name, args
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time_ns()
+        pid, tid = os.getpid(), threading.get_ident()
+        _name_thread(self.events, pid, tid)
+        self.events.append({'name': self.name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                            'ts': self.start // 1000, 'dur': (end - self.start) // 1000, 'args': self.args})
+
+class _AsyncSpan(_Span):
+    # For spans that overlap others on the same thread (asyncio tasks)
+    __slots__ = ('id',)
+
+    def __enter__(self):
+        self.id = next(_ids)
+        self.start = time.time_ns()
+        self.events.append({'name': self.name, 'cat': 'async', 'ph': 'b', 'id': self.id, 'pid': os.getpid(),
+                            'tid': threading.get_ident(), 'ts': self.start // 1000, 'args': self.args})
+        return self
+
+    def __exit__(self, *exc):
+        self.events.append({'name': self.name, 'cat': 'async', 'ph': 'e', 'id': self.id, 'pid': os.getpid(),
+                            'tid': threading.get_ident(), 'ts': time.time_ns() // 1000})
+
+def span(name, **args):
+    '''Context manager recording how long its body takes as `name`.'''
+    events = _events
+    return _NULL if events is None else _Span(events, name, args)
+
+def async_span(name, **args):
+    events = _events
+    return _NULL if events is None else _AsyncSpan(events, name, args)
+
+def save_part(path, events):
+    '''Write one process' events next to `path`, for merge() to collect.'''
+    with open(f'{path}.{os.getpid()}.part', 'w') as f:
+        json.dump(events, f)
+
+def merge(path, events=()):
+    '''`events` plus those of every save_part() for `path`, which are removed.'''
+    events = list(events)
+    for part in glob.glob(glob.escape(path) + '.*.part'):
+        with open(part) as f:
+            events.extend(json.load(f))
+        os.unlink(part)
+    return events
+
+def write(path, events):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def summary(events):
+    '''name -> (count, total seconds) of the spans in `events`.'''
+    res = {}
+    opened = {}
+    for ev in events:
+        if ev['ph'] == 'X':
+            dur = ev['dur']
+        elif ev['ph'] == 'b':
+            opened[ev['pid'], ev['id']] = ev['ts']
+            continue
+        elif ev['ph'] == 'e' and (ev['pid'], ev['id']) in opened:
+            dur = ev['ts'] - opened.pop((ev['pid'], ev['id']))
+        else:
+            continue
+        n, total = res.get(ev['name'], (0, 0.0))
+        res[ev['name']] = (n + 1, total + dur / 1e6)
+    return res
@@ -1,4 +1,4 @@
-import io, csv, os
+import io, csv, itertools
 import run, batch
 
 def row_to_contents(hdr, row):
@@ -17,40 +17,35 @@ def row_to_contents(hdr, row):
             out.writerow(row)
     return nm, sio.getvalue()
 
-def make_cases(db, rows, pops, evids):
+def make_cases(db, rows, pops, evids, **axes):
+    # Parameters default to "as FST"; pass lists of values to sweep them
+    axes = {'contributors': 3, 'theta': 0.03, 'drop_in': 0.02, 'drop_out': 0.05, 'rare': 0.0, **axes}
+    sweep = run.Sweep(evids, population=pops, **{
+        k: v if isinstance(v, (list, tuple)) else [v] for k, v in axes.items()
+    })
     for row in rows[1:]:
-        for pop in pops:
-            sampname, contents = row_to_contents(rows[0], row)
-            case = run.Case()\
-                .with_population(pop)\
-                .add_profiles(run.Profile('sib', sample_name=sampname))\
-                .add_evidence(*evids)\
-                .typical_hypotheses(sampname, 3)
-            # "as FST"
-            for hyp in case.hyp:
-                hyp.theta, hyp.drop_in, hyp.default_drop_out = 0.03, 0.02, 0.05
-            case.rare = 0.0
+        sampname, contents = row_to_contents(rows[0], row)
+        for case in sweep.cases(run.Profile('sib', sample_name=sampname)):
             dbrow = db.add_cases(case)[0]
             db.set_files(dbrow, {'sib': contents})
 
 def extract_overall_lrs(db):
-    for case, data in db.iter_results():
-        pop = os.path.basename(case.hyp.p.population).partition('_')[0]
-        contr = next(iter(case.profiles.keys()))
-        for row in data:
-            if row['Locus'] == '_OVERALL_':
-                yield contr, pop, float(row['LR']), float(row['LRLog10'])
+    db.backfill()
+    for _, contr, pop, lr, lr10 in db.iter_overall():
+        yield contr, batch.population_name(pop), lr, lr10
 
-def into_plot_csv(res, fn, cs):
-    pops = set()
-    contrs = {}
-    for contr, pop, lr, lr10 in res:
-        pops.add(pop)
-        contrs.setdefault(contr, {})[pop] = lr
-    f = open(fn, 'w')
-    out = csv.DictWriter(f, ['Case', 'Contributor'] + list(pops))
-    out.writeheader()
-    for contr, rest in contrs.items():
-        out.writerow({'Case': cs, 'Contributor': contr, **rest})
-    f.flush()
-    f.close()
+def into_plot_csv(res, fn, cs, pops=None):
+    # res must come grouped by contributor (as extract_overall_lrs yields
+    # it); if pops isn't given it's collected with a first pass over res.
+    if pops is None:
+        res = list(res)
+        pops = sorted({pop for _, pop, _, _ in res})
+    with open(fn, 'w') as f:
+        out = csv.DictWriter(f, ['Case', 'Contributor'] + list(pops))
+        out.writeheader()
+        for contr, rest in itertools.groupby(res, key=lambda r: r[0]):
+            out.writerow({'Case': cs, 'Contributor': contr, **{pop: lr for _, pop, lr, _ in rest}})
+        f.flush()
+
+def extract_plot_csv(db, fn, cs):
+    into_plot_csv(extract_overall_lrs(db), fn, cs, db.populations())